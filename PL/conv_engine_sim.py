@@ -0,0 +1,303 @@
+"""
+conv_engine_sim.py — bit-accurate NumPy model of the HLS conv_engine IP
+
+Same register-level arguments, same DRAM side effects as
+HLS/conv_engine.cpp, so the host pipeline (tinyyolo_pynq.ipynb) can be
+benchmarked and regression-tested on any x86 box without a ZCU102.
+
+What is modelled exactly
+------------------------
+ - data_t = ap_fixed<16,8,AP_RND,AP_SAT> activations / weights / BN params
+   (int16, 8 fractional bits)
+ - acc_t  = ap_fixed<32,16,AP_RND,AP_SAT> accumulator (int32, 16 fractional
+   bits) with the HLS accumulation order: per output pixel the IC tiles are
+   the outer loop, (ky, kx) the inner loop, and each (ky, kx) step adds a
+   16-IC dot product that itself saturates after every MAC
+ - BN: acc * scale rounded (AP_RND) + saturated to acc_t, + bias, rounded +
+   saturated to data_t; then linear / ReLU / LeakyReLU (x*13 >> 7)
+ - Write_Layer: direct write, or the 2×2 tile-local MaxPool when
+   use_pool && pool_stride >= 2 (pool_stride == 1 falls through to a
+   direct write, like the hardware)
+ - 256-bit DRAM words: 16 int16 elements per word, element i in word i>>4,
+   slot i&15 (little-endian) — a flat int16 array. Only the output elements
+   the IP writes are modified; the edge read-modify-write keeps neighbours.
+
+Speed
+-----
+Convolution is one float64 im2col matmul per layer. Every product is an
+exact integer < 2^30 and every partial sum stays < 2^53, so float64 is
+exact for the integer dot product. The sequential saturating emulation is
+only run for the outputs whose sum of |products| can leave the int32
+range (rare with trained weights). The full 10-layer Tiny-YOLO schedule
+runs in a few seconds:
+
+    python conv_engine_sim.py
+"""
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# ── Tile parameters (must match conv_engine.h) ─────────────────────────────
+TILE_H  = 16
+TILE_W  = 16
+TILE_IC = 16
+TILE_OC = 16
+K_MAX   = 3
+MAX_STRIDE = 2
+ELEMS_PER_WORD = 16                    # 256-bit word / 16-bit element
+
+# ── Fixed-point formats ────────────────────────────────────────────────────
+FRAC_BITS     = 8                      # data_t  ap_fixed<16,8>
+ACC_FRAC_BITS = 16                     # acc_t   ap_fixed<32,16>
+DATA_MIN, DATA_MAX = -(1 << 15), (1 << 15) - 1
+ACC_MIN,  ACC_MAX  = -(1 << 31), (1 << 31) - 1
+
+
+# ── DRAM views ──────────────────────────────────────────────────────────────
+
+def dram_elements(buf):
+    """
+    Flat int16 view of a DRAM buffer (no copy — writes go to `buf`).
+
+    Accepts anything with the IP's memory layout: an int16 array or
+    PynqBuffer, a raw uint8 byte buffer, or an (N, 16) array of words.
+    """
+    arr = np.asarray(buf)
+    if not arr.flags.c_contiguous:
+        raise ValueError('DRAM buffer must be C-contiguous')
+    if arr.dtype != np.int16:
+        arr = arr.reshape(-1).view(np.int16)
+    return arr.reshape(-1)
+
+
+def dram_words(buf):
+    """(N, 16) int16 view: row n is 256-bit word n, column s is slot s."""
+    elems = dram_elements(buf)
+    n_words = len(elems) // ELEMS_PER_WORD
+    return elems[:n_words * ELEMS_PER_WORD].reshape(n_words, ELEMS_PER_WORD)
+
+
+def conv_output_size(in_height, in_width, kernel_size, stride, padding,
+                     use_pool=0, pool_stride=0):
+    """(OH, OW) the IP writes to DRAM (after the optional stride-≥2 pool)."""
+    out_h = (in_height + 2 * padding - kernel_size) // stride + 1
+    out_w = (in_width  + 2 * padding - kernel_size) // stride + 1
+    if use_pool and pool_stride >= 2:
+        return out_h // pool_stride, out_w // pool_stride
+    return out_h, out_w
+
+
+# ── Fixed-point arithmetic ─────────────────────────────────────────────────
+
+def _saturate(x, lo, hi):
+    return np.clip(x, lo, hi, out=x)
+
+
+def _round_shift(x, shift):
+    """AP_RND quantization: drop `shift` fractional bits, ties toward +inf."""
+    return (x + (1 << (shift - 1))) >> shift
+
+
+def _accumulate_saturating(patches, weights):
+    """
+    Exact acc_t accumulation for a set of outputs, in HLS loop order.
+
+    patches, weights : int64 [n, IC, K, K] (raw data_t values)
+    Returns int64 [n] raw acc_t values.
+    """
+    n, in_channels, k, _ = patches.shape
+    ti_steps = (in_channels + TILE_IC - 1) // TILE_IC
+    prod = np.zeros((n, ti_steps * TILE_IC, k, k), dtype=np.int64)
+    prod[:, :in_channels] = patches * weights       # data_t × data_t: exact in acc_t
+    prod = prod.reshape(n, ti_steps, TILE_IC, k, k)
+
+    acc = np.zeros(n, dtype=np.int64)
+    for ti in range(ti_steps):
+        for ky in range(k):
+            for kx in range(k):
+                dot = np.zeros(n, dtype=np.int64)
+                for ic in range(TILE_IC):
+                    dot = _saturate(dot + prod[:, ti, ic, ky, kx], ACC_MIN, ACC_MAX)
+                acc = _saturate(acc + dot, ACC_MIN, ACC_MAX)
+    return acc
+
+
+def conv_accumulate(x, w, stride, padding):
+    """
+    acc_t convolution of one layer.
+
+    x : int16 [IC, H, W]      raw data_t input feature map
+    w : int16 [OC, IC, K, K]  raw data_t weights
+    Returns int64 [OC, OH, OW] raw acc_t accumulators.
+    """
+    in_channels, in_h, in_w = x.shape
+    out_channels, _, k, _ = w.shape
+    out_h = (in_h + 2 * padding - k) // stride + 1
+    out_w = (in_w + 2 * padding - k) // stride + 1
+
+    # Out-of-range taps read the zero-filled input cache
+    xp = np.pad(x.astype(np.float64), ((0, 0), (padding, padding), (padding, padding)))
+    win = sliding_window_view(xp, (k, k), axis=(1, 2))          # [IC, H', W', K, K]
+    win = win[:, :(out_h - 1) * stride + 1:stride, :(out_w - 1) * stride + 1:stride]
+    cols = win.transpose(1, 2, 0, 3, 4).reshape(out_h * out_w, in_channels * k * k)
+    wf = w.reshape(out_channels, -1).astype(np.float64)
+
+    acc = cols @ wf.T                                           # [OH*OW, OC], exact
+    acc = acc.astype(np.int64)
+
+    # Saturation is only possible where sum |prod| exceeds the acc_t range.
+    # Cheap per-OC bound first, exact |x|·|w| only for the OCs that fail it.
+    abs_w = np.abs(wf)
+    bound = abs_w.sum(axis=1) * np.abs(cols).max(initial=0.0)
+    risky = np.nonzero(bound > ACC_MAX)[0]
+    if len(risky):
+        abs_sum = np.abs(cols) @ abs_w[risky].T                 # [OH*OW, n_risky]
+        pix, j = np.nonzero(abs_sum > ACC_MAX)
+        if len(pix):
+            oc = risky[j]
+            patches = cols[pix].astype(np.int64).reshape(-1, in_channels, k, k)
+            acc[pix, oc] = _accumulate_saturating(patches, w[oc].astype(np.int64))
+
+    return acc.T.reshape(out_channels, out_h, out_w)
+
+
+def bn_activate(acc, scale, bias, use_leaky):
+    """
+    Execute_Layer post-processing: BN in acc_t, cast to data_t, activate.
+
+    acc   : int64 [OC, ...] raw acc_t
+    scale : int16 [OC] raw data_t;  bias : int16 [OC] raw data_t
+    Returns int16 [OC, ...] raw data_t.
+    """
+    shape = (-1,) + (1,) * (acc.ndim - 1)
+    scale = scale.astype(np.int64).reshape(shape)
+    bias = bias.astype(np.int64).reshape(shape)
+
+    # acc_t bn_mul = acc * scale   (24 → 16 fractional bits)
+    bn_mul = _saturate(_round_shift(acc * scale, FRAC_BITS), ACC_MIN, ACC_MAX)
+    # (data_t)(bn_mul + bias)      (16 → 8 fractional bits)
+    v = bn_mul + (bias << (ACC_FRAC_BITS - FRAC_BITS))
+    y = _saturate(_round_shift(v, ACC_FRAC_BITS - FRAC_BITS), DATA_MIN, DATA_MAX)
+
+    if use_leaky >= 0:
+        neg = y < 0
+        if use_leaky > 0:
+            # tmp = (acc_t)x * 13 >> 7, then (data_t)tmp with AP_RND
+            y[neg] = _round_shift(y[neg] * 13, 7)
+        else:
+            y[neg] = 0
+    return y.astype(np.int16)
+
+
+def write_output(out, y, use_pool, pool_stride):
+    """
+    Write_Layer: store [OC, OH, OW] results into the flat output DRAM view.
+
+    The pooled path is tile-local, exactly like the hardware: per 16×16
+    tile, ph = curr_h / pool_stride rows of 2×2 maxima taken at rows
+    2*pi, 2*pi+1, written at row r_start / pool_stride + pi.
+    """
+    out_channels, out_h, out_w = y.shape
+    if not (use_pool and pool_stride >= 2):
+        out[:y.size] = y.ravel()
+        return
+
+    final_h, final_w = out_h // pool_stride, out_w // pool_stride
+    oc_base = np.arange(out_channels)[:, None, None] * final_h
+    for r_start in range(0, out_h, TILE_H):
+        for c_start in range(0, out_w, TILE_W):
+            tile = y[:, r_start:r_start + TILE_H, c_start:c_start + TILE_W]
+            ph, pw = tile.shape[1] // pool_stride, tile.shape[2] // pool_stride
+            if ph == 0 or pw == 0:
+                continue
+            pooled = tile[:, :2 * ph, :2 * pw].reshape(out_channels, ph, 2, pw, 2).max(axis=(2, 4))
+            rows = r_start // pool_stride + np.arange(ph)[:, None]
+            cols = c_start // pool_stride + np.arange(pw)[None, :]
+            out[(oc_base + rows) * final_w + cols] = pooled
+
+
+# ── Top level ───────────────────────────────────────────────────────────────
+
+def conv_engine(input_dram, output_dram, weights_dram, bn_params_dram,
+                in_channels, out_channels,
+                in_height, in_width,
+                kernel_size, stride, padding,
+                use_pool, pool_stride,
+                use_leaky):
+    """
+    Software conv_engine: one IP call, same arguments as the HLS top level.
+
+    Parameters
+    ----------
+    input_dram     : int16 CHW feature map [IC*H*W] (or any dram_elements() layout)
+    output_dram    : buffer the result is written into, CHW [OC*OH*OW]
+    weights_dram   : int16 flat OIHW weights [OC*IC*K*K]
+    bn_params_dram : int16 interleaved [scale_0, bias_0, scale_1, bias_1, ...]
+    use_leaky      : 1 = LeakyReLU, 0 = ReLU, -1 = linear
+
+    Like the IP, returns nothing; output_dram is modified in place.
+    """
+    if kernel_size > K_MAX:
+        return                                  # IP returns without touching DRAM
+    if not 1 <= stride <= MAX_STRIDE:
+        raise ValueError(f'stride {stride} outside 1..{MAX_STRIDE} overflows the input cache')
+
+    x = dram_elements(input_dram)[:in_channels * in_height * in_width]
+    x = x.reshape(in_channels, in_height, in_width)
+    n_wt = out_channels * in_channels * kernel_size * kernel_size
+    w = dram_elements(weights_dram)[:n_wt]
+    w = w.reshape(out_channels, in_channels, kernel_size, kernel_size)
+    bn = dram_elements(bn_params_dram)[:2 * out_channels]
+
+    acc = conv_accumulate(x, w, stride, padding)
+    y = bn_activate(acc, bn[0::2], bn[1::2], use_leaky)
+    write_output(dram_elements(output_dram), y, use_pool, pool_stride)
+
+
+def run_layer(ip_args, input_dram, output_dram, weights_dram, bn_params_dram):
+    """conv_engine() driven by a LAYERS-style dict (ic, oc, ih, iw, k, s, p, ...)."""
+    L = ip_args
+    conv_engine(input_dram, output_dram, weights_dram, bn_params_dram,
+                L['ic'], L['oc'], L['ih'], L['iw'], L['k'], L['s'], L['p'],
+                L['use_pool'], L['pool_stride'], L['use_leaky'])
+
+
+# ── Benchmark: full Tiny-YOLO schedule on random Q8.8 data ──────────────────
+if __name__ == '__main__':
+    schedule = [
+        # name     ic    oc    hw   k  p  pool  ps  act
+        ('conv1',    3,   16, 416, 3, 1, 1, 2,  1),
+        ('conv2',   16,   32, 208, 3, 1, 1, 2,  1),
+        ('conv3',   32,   64, 104, 3, 1, 1, 2,  1),
+        ('conv4',   64,  128,  52, 3, 1, 1, 2,  1),
+        ('conv5',  128,  256,  26, 3, 1, 1, 2,  1),
+        ('conv6',  256,  512,  13, 3, 1, 0, 0,  1),
+        ('conv7',  512, 1024,  13, 3, 1, 0, 0,  1),
+        ('conv8', 1024,  256,  13, 1, 0, 0, 0,  1),
+        ('conv9',  256,  512,  13, 3, 1, 0, 0,  1),
+        ('det',    512,  425,  13, 1, 0, 0, 0, -1),
+    ]
+    rng = np.random.default_rng(0)
+    buf_a = np.zeros(16 * 416 * 416, dtype=np.int16)
+    buf_b = np.zeros_like(buf_a)
+    buf_a[:3 * 416 * 416] = rng.integers(-512, 512, 3 * 416 * 416)
+
+    total = 0.0
+    for name, ic, oc, hw, k, p, use_pool, ps, act in schedule:
+        fan_in = ic * k * k
+        wt = np.clip(rng.normal(0, 256 / np.sqrt(fan_in), oc * fan_in), -32768, 32767).astype(np.int16)
+        bn = np.empty(2 * oc, dtype=np.int16)
+        bn[0::2] = rng.integers(128, 384, oc)     # scale ≈ 0.5 … 1.5
+        bn[1::2] = rng.integers(-64, 64, oc)      # bias  ≈ ±0.25
+
+        t0 = time.perf_counter()
+        conv_engine(buf_a, buf_b, wt, bn, ic, oc, hw, hw, k, 1, p, use_pool, ps, act)
+        dt = time.perf_counter() - t0
+        total += dt
+        oh, ow = conv_output_size(hw, hw, k, 1, p, use_pool, ps)
+        print(f'{name:6s} {ic:>5d}→{oc:<5d} out {oc}×{oh}×{ow:<4d} {dt * 1000:8.1f} ms')
+        buf_a, buf_b = buf_b, buf_a
+
+    print(f'{"total":6s} {"":30s} {total * 1000:8.1f} ms')
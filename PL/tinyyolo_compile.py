@@ -0,0 +1,394 @@
+"""
+tinyyolo_compile.py — compile a PyTorch Tiny-YOLO into a conv_engine schedule
+
+Replaces the hand-typed LAYERS list: compile_schedule() runs one dummy
+forward pass with hooks on the leaf modules, groups what it sees into IP
+calls and emits, per layer,
+
+  - the LAYERS dict the runtime uses (ic/oc/ih/iw/k/s/p/use_pool/...)
+  - the exact AXI-Lite register values (regs, address registers excluded)
+  - the PS fallback ops that follow the IP call (sw_ops, e.g. the stride-1
+    pool that Write_Layer does not implement)
+  - feature-map element counts and the weight / BN offsets inside a single
+    parameter arena (the WeightResidency region)
+
+together with the fixed-point weights and fused BN params. load_schedule()
+caches all of it as an .npz keyed by a hash of the architecture and the
+weights, so reloading a model skips the extraction entirely.
+
+With classes=[...] the detection head (last layer, linear) is pruned to the
+box / objectness channels plus the logits of those classes, so the IP only
+computes e.g. 5×(5+6) = 55 of the 425 output channels.
+
+Recognised patterns (Dropout is skipped, it is identity at inference):
+  Conv2d [BatchNorm2d] [LeakyReLU(0.1) | ReLU] [MaxPool2d(2, 2)]
+  Conv2d [BatchNorm2d] [LeakyReLU(0.1) | ReLU] ZeroPad2d((0,1,0,1)) MaxPool2d(2, 1)
+Anything else raises ValueError naming the module.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from tinyyolo_host import (
+    REG_IN_CHANNELS, REG_OUT_CHANNELS, REG_IN_HEIGHT, REG_IN_WIDTH,
+    REG_KERNEL_SIZE, REG_STRIDE, REG_PADDING, REG_USE_POOL, REG_POOL_STRIDE,
+    REG_USE_LEAKY, float_to_fixed, pad16, hw_output_size, hw_layer_config,
+    layer_sw_ops, param_layout,
+)
+from conv_engine_sim import K_MAX, MAX_STRIDE
+
+
+COMPILER_VERSION = 3          # bump when the emitted schedule format changes
+
+# HLS LeakyReLU is (x * 13) >> 7, i.e. slope 0.1015625
+LEAKY_SLOPE = 0.1
+
+
+# ── BN folding (matches the HLS BN stage) ──────────────────────────────────
+
+def fuse_conv_bn(conv_weight, conv_bias, bn_gamma, bn_beta,
+                 bn_mean, bn_var, eps=1e-5):
+    """
+    Compute the scale[] and bias[] arrays expected by the HLS BN stage.
+
+    HLS engine does:  val = acc * scale[oc] + bias[oc]
+    PyTorch BN does:  y = gamma*(x-mean)/sqrt(var+eps) + beta
+
+    Returns
+    -------
+    scale : ndarray [OC]   gamma / sqrt(var + eps)
+    bias  : ndarray [OC]   beta - gamma*mean / sqrt(var + eps)  (+ conv_bias folded in)
+    """
+    inv_std = 1.0 / np.sqrt(bn_var + eps)
+    scale = bn_gamma * inv_std
+    if conv_bias is not None:
+        bias = bn_beta + scale * (conv_bias - bn_mean)
+    else:
+        bias = bn_beta - scale * bn_mean
+    return scale.astype(np.float32), bias.astype(np.float32)
+
+
+def pack_bn_params(scale, bias):
+    """
+    Interleave scale/bias into the flat layout the HLS IP expects:
+      [scale_0, bias_0, scale_1, bias_1, ...]
+    Returns int16 array.
+    """
+    oc = len(scale)
+    buf = np.empty(oc * 2, dtype=np.float32)
+    buf[0::2] = scale
+    buf[1::2] = bias
+    return float_to_fixed(buf)
+
+
+def _numpy(t):
+    return t.detach().cpu().numpy()
+
+
+def _fold(conv, bn):
+    """int16 weights + packed BN params for one IP call (identity BN if none)."""
+    w = _numpy(conv.weight)
+    b = _numpy(conv.bias) if conv.bias is not None else None
+    if bn is not None:
+        scale, bias = fuse_conv_bn(w, b, _numpy(bn.weight), _numpy(bn.bias),
+                                   _numpy(bn.running_mean), _numpy(bn.running_var),
+                                   bn.eps)
+    else:
+        # HLS applies out = acc * scale + bias → scale=1, bias=conv bias
+        scale = np.ones(w.shape[0], dtype=np.float32)
+        bias = b if b is not None else np.zeros(w.shape[0], dtype=np.float32)
+    return float_to_fixed(w.ravel()), pack_bn_params(scale, bias)
+
+
+# ── Model hash ─────────────────────────────────────────────────────────────
+
+def model_hash(model, input_size=416, classes=None):
+    """sha256 over the architecture, input size, class subset and every state_dict tensor."""
+    h = hashlib.sha256()
+    classes = None if classes is None else sorted(set(int(c) for c in classes))
+    h.update(f'v{COMPILER_VERSION} {input_size} {classes} {model!r}'.encode())
+    for name, tensor in model.state_dict().items():
+        arr = np.ascontiguousarray(_numpy(tensor))
+        h.update(f'{name} {arr.dtype} {arr.shape}'.encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+# ── Graph walk ─────────────────────────────────────────────────────────────
+
+def _trace(model, input_size):
+    """Leaf modules in execution order: [(name, module, in_shape, out_shape)]."""
+    names = {m: n for n, m in model.named_modules()}
+    events = []
+    hooks = [m.register_forward_hook(
+                 lambda m, inp, out: events.append(
+                     (names[m], m, tuple(inp[0].shape[1:]), tuple(out.shape[1:]))))
+             for m in model.modules() if not list(m.children())]
+
+    was_training = model.training
+    device = next(model.parameters()).device
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, 3, input_size, input_size, device=device))
+    finally:
+        for hook in hooks:
+            hook.remove()
+        model.train(was_training)
+    return events
+
+
+def _layer_name(module_name):
+    # 'conv1.conv' → 'conv1';  'detection' → 'det' (as in TINYYOLO_LAYERS)
+    if module_name == 'detection':
+        return 'det'
+    parent, _, leaf = module_name.rpartition('.')
+    return parent if parent and leaf == 'conv' else module_name
+
+
+def _unsupported(name, why):
+    return ValueError(f'{name}: {why} — conv_engine has no HW or SW path for it')
+
+
+def _compile_conv(name, conv, in_shape):
+    k, k2 = conv.kernel_size
+    s, s2 = conv.stride
+    p, p2 = conv.padding if not isinstance(conv.padding, str) else (None, None)
+    if conv.groups != 1 or conv.dilation != (1, 1):
+        raise _unsupported(name, 'grouped / dilated conv')
+    if k != k2 or k > K_MAX:
+        raise _unsupported(name, f'kernel {conv.kernel_size} (max {K_MAX}×{K_MAX})')
+    if s != s2 or s > MAX_STRIDE:
+        raise _unsupported(name, f'stride {conv.stride} (max {MAX_STRIDE})')
+    if p is None or p != p2:
+        raise _unsupported(name, f'padding {conv.padding}')
+    ic, ih, iw = in_shape
+    return dict(name=_layer_name(name), ic=ic, oc=conv.out_channels, ih=ih, iw=iw,
+                k=k, s=s, p=p, use_pool=0, pool_stride=0, use_leaky=-1)
+
+
+def det_channels(num_anchors, num_classes, class_ids):
+    """
+    Detection-head output channels needed for a class subset.
+
+    Per anchor: the 5 box / objectness channels, then the chosen class
+    logits, in order — i.e. the [A×(5+K), H, W] layout decode expects for K
+    classes.
+    """
+    per_anchor = np.concatenate([np.arange(5), 5 + np.asarray(class_ids, dtype=np.int64)])
+    return (np.arange(num_anchors)[:, None] * (5 + num_classes) + per_anchor).ravel()
+
+
+def _prune_det(L, w, bn_fp, num_classes, class_ids):
+    """Keep only the det_channels() output rows of the final linear conv."""
+    if L['use_leaky'] != -1 or L['use_pool']:
+        raise ValueError(f"{L['name']}: class pruning needs a linear detection head "
+                         f"as the last layer")
+    if num_classes is None or L['oc'] % (5 + num_classes):
+        raise ValueError(f"{L['name']}: {L['oc']} output channels is not "
+                         f"anchors × (5 + {num_classes})")
+    if not all(0 <= c < num_classes for c in class_ids):
+        raise ValueError(f'class ids {class_ids} outside 0..{num_classes - 1}')
+    channels = det_channels(L['oc'] // (5 + num_classes), num_classes, class_ids)
+    w = w.reshape(L['oc'], -1)[channels].ravel()
+    bn_fp = bn_fp.reshape(L['oc'], 2)[channels].ravel()
+    L['oc'] = len(channels)
+    return w, bn_fp, channels
+
+
+def compile_schedule(model, input_size=416, classes=None):
+    """
+    Walk `model` and emit its conv_engine Schedule.
+
+    Parameters
+    ----------
+    model      : TinyYOLO (or any Conv/BN/act/pool chain of the patterns above)
+    input_size : square input resolution the schedule is compiled for
+    classes    : optional class indices to keep; the last (detection) layer
+                 then only computes their logits (see det_channels)
+    """
+    events = [e for e in _trace(model, input_size)
+              if not isinstance(e[1], (nn.Dropout, nn.Dropout2d, nn.Identity))]
+
+    layers, weights, bn_params = [], [], []
+    i = 0
+    while i < len(events):
+        name, module, in_shape, _ = events[i]
+        if not isinstance(module, nn.Conv2d):
+            raise _unsupported(name, f'{type(module).__name__} outside a conv block')
+        L = _compile_conv(name, module, in_shape)
+        conv, bn = module, None
+        i += 1
+
+        def peek(kind):
+            return i < len(events) and isinstance(events[i][1], kind)
+
+        if peek(nn.BatchNorm2d):
+            bn = events[i][1]
+            i += 1
+        if peek(nn.LeakyReLU):
+            if abs(events[i][1].negative_slope - LEAKY_SLOPE) > 1e-6:
+                raise _unsupported(events[i][0], 'LeakyReLU slope != 0.1')
+            L['use_leaky'] = 1
+            i += 1
+        elif peek(nn.ReLU):
+            L['use_leaky'] = 0
+            i += 1
+
+        if peek(nn.MaxPool2d) and events[i][1].kernel_size in (2, (2, 2)) \
+                and events[i][1].stride in (2, (2, 2)):
+            L['use_pool'], L['pool_stride'] = 1, 2
+            i += 1
+        elif peek(nn.ZeroPad2d) and tuple(events[i][1].padding) == (0, 1, 0, 1) \
+                and i + 1 < len(events) and isinstance(events[i + 1][1], nn.MaxPool2d) \
+                and events[i + 1][1].kernel_size in (2, (2, 2)) \
+                and events[i + 1][1].stride in (1, (1, 1)):
+            # ZeroPad2d(0,1,0,1) → MaxPool2d(2, 1): runs as a PS op after the IP
+            L['use_pool'], L['pool_stride'] = 1, 1
+            i += 2
+
+        # The compiled shape must match what PyTorch produced
+        expected = events[i - 1][3]
+        if hw_output_size(L) != expected:
+            raise _unsupported(name, f'output {hw_output_size(L)} != PyTorch {expected}')
+
+        w, bn_fp = _fold(conv, bn)
+        layers.append(L)
+        weights.append(w)
+        bn_params.append(bn_fp)
+
+    class_ids = channels = None
+    if classes is not None:
+        class_ids = sorted(set(int(c) for c in classes))
+        weights[-1], bn_params[-1], channels = _prune_det(
+            layers[-1], weights[-1], bn_params[-1],
+            getattr(model, 'num_classes', None), class_ids)
+
+    return Schedule(layers, weights, bn_params, model_hash(model, input_size, classes),
+                    input_size, class_ids, channels)
+
+
+# ── Schedule ───────────────────────────────────────────────────────────────
+
+_REGISTERS = [
+    (REG_IN_CHANNELS, 'ic'), (REG_OUT_CHANNELS, 'oc'),
+    (REG_IN_HEIGHT, 'ih'), (REG_IN_WIDTH, 'iw'),
+    (REG_KERNEL_SIZE, 'k'), (REG_STRIDE, 's'), (REG_PADDING, 'p'),
+    (REG_USE_POOL, 'use_pool'), (REG_POOL_STRIDE, 'pool_stride'),
+    (REG_USE_LEAKY, 'use_leaky'),
+]
+
+
+class Schedule:
+    """
+    A compiled conv_engine program.
+
+    layers    : LAYERS dicts, each extended with
+                  regs      [(offset, u32 value)] scalar registers for the IP
+                  sw_ops    PS ops after the IP call
+                  in_elems / out_elems   feature-map int16 elements
+                  wt_offset / bn_offset  int16 offsets in the parameter arena
+    weights   : int16 flat OIHW arrays, one per layer
+    bn_params : int16 [s0,b0,s1,b1,...] arrays, one per layer
+    arena     : fm_elems (each ping-pong buffer), param_elems, total_bytes
+    class_ids : class subset the detection layer was pruned to (None = all);
+                decode the output with K = len(class_ids) classes and map
+                class k back to class_ids[k]
+    det_channels : the full-model output channels the pruned layer computes
+    """
+
+    def __init__(self, layers, weights, bn_params, model_hash, input_size,
+                 class_ids=None, det_channels=None):
+        self.layers = [dict(L) for L in layers]
+        self.weights = weights
+        self.bn_params = bn_params
+        self.model_hash = model_hash
+        self.input_size = input_size
+        self.class_ids = None if class_ids is None else list(class_ids)
+        self.det_channels = (None if det_channels is None
+                             else [int(c) for c in det_channels])
+
+        offsets, param_elems = param_layout([len(w) for w in weights],
+                                            [len(bn) for bn in bn_params])
+        fm_elems = 0
+        for L, (w_off, bn_off) in zip(self.layers, offsets):
+            oc, oh, ow = hw_output_size(L)
+            hw = hw_layer_config(L)
+            L['in_elems'] = L['ic'] * L['ih'] * L['iw']
+            L['out_elems'] = oc * oh * ow
+            L['wt_offset'], L['bn_offset'] = w_off, bn_off
+            L['sw_ops'] = layer_sw_ops(L)
+            L['regs'] = [(reg, hw[key] & 0xFFFFFFFF) for reg, key in _REGISTERS]
+            fm_elems = max(fm_elems, L['in_elems'], L['out_elems'])
+
+        fm_elems = pad16(fm_elems)
+        self.arena = dict(fm_elems=fm_elems, param_elems=param_elems,
+                          total_bytes=2 * (2 * fm_elems + param_elems))
+
+    def report(self):
+        """Print the schedule: shapes, activation, SW ops and arena offsets."""
+        print(f"Schedule {self.model_hash[:12]}  input {self.input_size}×{self.input_size}")
+        for L in self.layers:
+            act = 'leaky' if L['use_leaky'] > 0 else \
+                  'relu'  if L['use_leaky'] == 0 else 'linear'
+            oc, oh, ow = hw_output_size(L)
+            sw = ' +' + ','.join(L['sw_ops']) if L['sw_ops'] else ''
+            print(f"  {L['name']:10s} {L['ic']:>4d}×{L['ih']}×{L['iw']} → "
+                  f"{oc:>4d}×{oh}×{ow}  k{L['k']} s{L['s']} p{L['p']} "
+                  f"pool={L['use_pool']}/{L['pool_stride']} {act:6s}"
+                  f"  wt@{L['wt_offset']:>10,d}{sw}")
+        if self.class_ids is not None:
+            print(f"  classes: {self.class_ids} → {self.layers[-1]['name']} "
+                  f"computes {len(self.det_channels)} channels")
+        a = self.arena
+        print(f"  arena: 2 × {a['fm_elems']*2/1024:.1f} KB feature maps + "
+              f"{a['param_elems']*2/1024:.1f} KB params = "
+              f"{a['total_bytes']/2**20:.2f} MB")
+
+    # ── (De)serialisation ───────────────────────────────────────────────
+
+    def save(self, path):
+        meta = dict(version=COMPILER_VERSION, model_hash=self.model_hash,
+                    input_size=self.input_size, layers=self.layers,
+                    class_ids=self.class_ids, det_channels=self.det_channels)
+        arrays = {f'w{i}': w for i, w in enumerate(self.weights)}
+        arrays.update({f'bn{i}': bn for i, bn in enumerate(self.bn_params)})
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['version'] != COMPILER_VERSION:
+                raise ValueError(f'{path}: schedule format v{meta["version"]}, '
+                                 f'expected v{COMPILER_VERSION}')
+            n = len(meta['layers'])
+            weights = [data[f'w{i}'] for i in range(n)]
+            bn_params = [data[f'bn{i}'] for i in range(n)]
+        return cls(meta['layers'], weights, bn_params, meta['model_hash'],
+                   meta['input_size'], meta['class_ids'], meta['det_channels'])
+
+
+def load_schedule(model, input_size=416, cache_dir='.', classes=None):
+    """
+    compile_schedule() with an on-disk cache keyed by model_hash().
+
+    The cache file is <cache_dir>/schedule-<hash[:16]>.npz; any change to the
+    architecture, weights, input size or class subset produces a new hash.
+    """
+    digest = model_hash(model, input_size, classes)
+    path = os.path.join(cache_dir, f'schedule-{digest[:16]}.npz')
+    if os.path.exists(path):
+        schedule = Schedule.load(path)
+        if schedule.model_hash == digest:
+            return schedule
+    schedule = compile_schedule(model, input_size, classes)
+    os.makedirs(cache_dir, exist_ok=True)
+    schedule.save(path)
+    return schedule
@@ -0,0 +1,1183 @@
+"""
+tinyyolo_host.py — host runtime for the conv_engine IP
+
+Everything the PS does around the accelerator, behind a small device
+interface so it runs unchanged on the ZCU102 or on any Linux box:
+
+  PynqDevice  — the real IP: PYNQ MMIO register access + pynq.allocate
+  MockDevice  — in-process stand-in: emulates the AXI-Lite register map,
+                the ap_start / ap_done handshake and cacheable DDR buffers,
+                and runs each layer on conv_engine_sim (bit-accurate)
+
+A device provides:
+  allocate(shape, dtype)  → buffer with .physical_address, .flush(),
+                            .invalidate(), .freebuffer()
+  write(offset, value)    → 32-bit AXI-Lite register write
+  read(offset)            → 32-bit AXI-Lite register read
+
+ConvEngineRuntime owns the ping-pong feature-map buffers and the
+parameter memory (one resident weight/BN region, or per-layer streaming
+buffers as a fallback) and runs the layer schedule (run_inference) with
+the same flush / invalidate ordering on both devices. FramePipeline
+overlaps PS pre/post-processing of neighbouring frames with it.
+"""
+import asyncio
+import collections
+import glob
+import os
+import queue
+import select
+import struct
+import threading
+import time
+
+import numpy as np
+
+import conv_engine_sim
+
+
+# ── AXI-Lite register offsets (from xconv_engine_hw.h) ─────────────────────
+REG_AP_CTRL      = 0x00
+REG_GIE          = 0x04   # global interrupt enable
+REG_IER          = 0x08   # bit 0: ap_done
+REG_ISR          = 0x0C   # bit 0: ap_done (toggle-on-write)
+REG_INPUT_DRAM   = 0x10   # 64-bit
+REG_OUTPUT_DRAM  = 0x1C   # 64-bit
+REG_WEIGHTS_DRAM = 0x28   # 64-bit
+REG_BN_PARAMS    = 0x34   # 64-bit
+REG_IN_CHANNELS  = 0x40
+REG_OUT_CHANNELS = 0x48
+REG_IN_HEIGHT    = 0x50
+REG_IN_WIDTH     = 0x58
+REG_KERNEL_SIZE  = 0x60
+REG_STRIDE       = 0x68
+REG_PADDING      = 0x70
+REG_USE_POOL     = 0x78
+REG_POOL_STRIDE  = 0x80
+REG_USE_LEAKY    = 0x88
+
+# ap_ctrl_hs bits in REG_AP_CTRL
+AP_START = 0x01
+AP_DONE  = 0x02           # clear-on-read
+AP_IDLE  = 0x04
+
+# ── Fixed-point: ap_fixed<16, 8, AP_RND, AP_SAT> ──────────────────────────
+FRAC_BITS = 8
+
+# ── Tiny-YOLO layer schedule: one dict per IP call ─────────────────────────
+# What tinyyolo_compile.compile_schedule() emits for the stock TinyYOLO at
+# 416×416; kept here for torch-free use (conv_engine_sim, mock tests).
+# use_leaky:  1 = LeakyReLU,  0 = ReLU,  -1 = Linear (detection layer)
+# use_pool:   0 = no pool,    1 = 2×2 maxpool
+# pool_stride: 2 runs on HW; 1 (conv6: ZeroPad2d(0,1,0,1) → MaxPool2d(2, 1))
+#              is not implemented by Write_Layer, so the runtime runs the
+#              conv without pooling and pools on the PS
+TINYYOLO_LAYERS = [
+    dict(name='conv1', ic=3,    oc=16,   ih=416, iw=416, k=3, s=1, p=1,
+         use_pool=1, pool_stride=2, use_leaky=1),
+    dict(name='conv2', ic=16,   oc=32,   ih=208, iw=208, k=3, s=1, p=1,
+         use_pool=1, pool_stride=2, use_leaky=1),
+    dict(name='conv3', ic=32,   oc=64,   ih=104, iw=104, k=3, s=1, p=1,
+         use_pool=1, pool_stride=2, use_leaky=1),
+    dict(name='conv4', ic=64,   oc=128,  ih=52,  iw=52,  k=3, s=1, p=1,
+         use_pool=1, pool_stride=2, use_leaky=1),
+    dict(name='conv5', ic=128,  oc=256,  ih=26,  iw=26,  k=3, s=1, p=1,
+         use_pool=1, pool_stride=2, use_leaky=1),
+    dict(name='conv6', ic=256,  oc=512,  ih=13,  iw=13,  k=3, s=1, p=1,
+         use_pool=1, pool_stride=1, use_leaky=1),
+    dict(name='conv7', ic=512,  oc=1024, ih=13,  iw=13,  k=3, s=1, p=1,
+         use_pool=0, pool_stride=0, use_leaky=1),
+    dict(name='conv8', ic=1024, oc=256,  ih=13,  iw=13,  k=1, s=1, p=0,
+         use_pool=0, pool_stride=0, use_leaky=1),
+    dict(name='conv9', ic=256,  oc=512,  ih=13,  iw=13,  k=3, s=1, p=1,
+         use_pool=0, pool_stride=0, use_leaky=1),
+    dict(name='det',   ic=512,  oc=5 * (5 + 80),
+         ih=13, iw=13, k=1, s=1, p=0,
+         use_pool=0, pool_stride=0, use_leaky=-1),
+]
+
+
+# ── Fixed-point helpers ─────────────────────────────────────────────────────
+
+def float_to_fixed(x, frac_bits=FRAC_BITS):
+    """float array  →  ap_fixed<16,8> stored as int16."""
+    scaled = np.round(x * (1 << frac_bits)).astype(np.int32)
+    return np.clip(scaled, -32768, 32767).astype(np.int16)
+
+
+def fixed_to_float(x, frac_bits=FRAC_BITS):
+    """int16 (ap_fixed<16,8>)  →  float."""
+    return x.astype(np.float32) / (1 << frac_bits)
+
+
+def pad16(n):
+    """Round up to next multiple of 16 (256-bit / 16-bit = 16 elements)."""
+    return ((n + 15) // 16) * 16
+
+
+def hw_output_size(L):
+    """Return (OC, OH, OW) that the IP writes to DRAM for layer L."""
+    oh = (L['ih'] + 2*L['p'] - L['k']) // L['s'] + 1
+    ow = (L['iw'] + 2*L['p'] - L['k']) // L['s'] + 1
+    if L['use_pool'] and L['pool_stride'] >= 2:
+        oh //= 2; ow //= 2
+    # pool_stride=1 → same spatial size
+    return L['oc'], oh, ow
+
+
+def layer_sw_ops(L):
+    """PS ops run after the IP call for layer L (the IP lacks stride-1 pooling)."""
+    return ['maxpool2x2_s1'] if L['use_pool'] and L['pool_stride'] < 2 else []
+
+
+def hw_layer_config(L):
+    """Layer L as programmed into the IP: SW-fallback pooling switched off."""
+    if layer_sw_ops(L):
+        return dict(L, use_pool=0, pool_stride=0)
+    return L
+
+
+def param_layout(weight_lens, bn_lens):
+    """
+    Offsets (int16 elements) of each layer's weights and BN params in one
+    region laid out [w0 | bn0 | w1 | bn1 | ...], every segment padded to a
+    256-bit word. Returns ([(w_off, bn_off), ...], total_elements).
+    """
+    offsets = []
+    total = 0
+    for wn, bn_n in zip(weight_lens, bn_lens):
+        offsets.append((total, total + pad16(wn)))
+        total += pad16(wn) + pad16(bn_n)
+    return offsets, total
+
+
+def sw_maxpool_stride1(data_chw, channels, h, w):
+    """
+    Replicate PyTorch:  ZeroPad2d(0,1,0,1) → MaxPool2d(2, stride=1)
+    Input  shape: (C, H, W)      e.g. (512, 13, 13)
+    Output shape: (C, H, W)      e.g. (512, 13, 13)
+    """
+    fm = data_chw.reshape(channels, h, w).astype(np.float32)
+    # Pad right and bottom by 1
+    padded = np.zeros((channels, h + 1, w + 1), dtype=np.float32)
+    padded[:, :h, :w] = fm
+    # 2×2 max pool with stride 1
+    out = np.maximum(
+        np.maximum(padded[:, 0:h, 0:w], padded[:, 1:h+1, 0:w]),
+        np.maximum(padded[:, 0:h, 1:w+1], padded[:, 1:h+1, 1:w+1])
+    )
+    return out.ravel()
+
+
+def sw_maxpool_stride1_inplace(fm):
+    """
+    ZeroPad2d(0,1,0,1) → MaxPool2d(2, stride=1) on int16 Q8.8 data, in place.
+
+    fm is a (C, H, W) int16 view, e.g. straight onto the DMA output buffer.
+    Bit-exact with the float route (sw_maxpool_stride1 between
+    fixed_to_float / float_to_fixed): the conversion is exact and monotone,
+    so max commutes with it. The 2×2 max is done separably, one column /
+    row at a time in increasing order — every op reads only elements that
+    are not yet overwritten, so there is no temporary or pad allocation.
+    """
+    h, w = fm.shape[1:]
+    # Horizontal: fm[y, x] = max(fm[y, x], fm[y, x+1]); zero pad at x = W
+    for x in range(w - 1):
+        np.maximum(fm[:, :, x], fm[:, :, x + 1], out=fm[:, :, x])
+    np.maximum(fm[:, :, w - 1], 0, out=fm[:, :, w - 1])
+    # Vertical: fm[y, x] = max(fm[y, x], fm[y+1, x]); zero pad at y = H
+    for y in range(h - 1):
+        np.maximum(fm[:, y, :], fm[:, y + 1, :], out=fm[:, y, :])
+    np.maximum(fm[:, h - 1, :], 0, out=fm[:, h - 1, :])
+    return fm
+
+
+# ── Register-level driver ───────────────────────────────────────────────────
+
+def write_reg64(dev, offset, val):
+    """Write a 64-bit value to two consecutive 32-bit registers."""
+    dev.write(offset,     val & 0xFFFFFFFF)
+    dev.write(offset + 4, (val >> 32) & 0xFFFFFFFF)
+
+
+def write_reg32_signed(dev, offset, val):
+    """Write a signed 32-bit int to a register (handles negative values)."""
+    dev.write(offset, val & 0xFFFFFFFF)
+
+
+def start_hw_conv(dev, in_buf, out_buf, wt_buf, bn_buf_hw, layer_cfg):
+    """
+    Program the conv_engine IP registers and pulse ap_start.
+
+    Parameters
+    ----------
+    dev        : PynqDevice / MockDevice (anything with write/read)
+    in_buf     : buffer with input feature map (int16, CHW packed)
+    out_buf    : buffer for output (pre-allocated)
+    wt_buf     : buffer with weights (int16, OIHW packed)
+    bn_buf_hw  : buffer with [scale, bias] interleaved (int16)
+    layer_cfg  : dict from LAYERS[]
+
+    Returns the perf_counter() time of ap_start.
+    """
+    L = layer_cfg
+
+    # ── Write 64-bit DMA base pointers ────────────────────────────────
+    write_reg64(dev, REG_INPUT_DRAM,   in_buf.physical_address)
+    write_reg64(dev, REG_OUTPUT_DRAM,  out_buf.physical_address)
+    write_reg64(dev, REG_WEIGHTS_DRAM, wt_buf.physical_address)
+    write_reg64(dev, REG_BN_PARAMS,    bn_buf_hw.physical_address)
+
+    # ── Write scalar parameters ───────────────────────────────────────
+    dev.write(REG_IN_CHANNELS,  L['ic'])
+    dev.write(REG_OUT_CHANNELS, L['oc'])
+    dev.write(REG_IN_HEIGHT,    L['ih'])
+    dev.write(REG_IN_WIDTH,     L['iw'])
+    dev.write(REG_KERNEL_SIZE,  L['k'])
+    dev.write(REG_STRIDE,       L['s'])
+    dev.write(REG_PADDING,      L['p'])
+    dev.write(REG_USE_POOL,     L['use_pool'])
+    dev.write(REG_POOL_STRIDE,  L['pool_stride'])
+    # use_leaky can be -1 (linear) — must handle signed→unsigned conversion
+    write_reg32_signed(dev, REG_USE_LEAKY, L['use_leaky'])
+
+    # ── Start IP ──────────────────────────────────────────────────────
+    dev.write(REG_AP_CTRL, AP_START)
+    return time.perf_counter()
+
+
+def run_hw_conv(dev, in_buf, out_buf, wt_buf, bn_buf_hw, layer_cfg,
+                timeout=120, waiter=None):
+    """
+    Run one conv layer: start_hw_conv() then block until ap_done.
+
+    waiter is a completion strategy (BusyPoll, BackoffPoll, PredictiveWait,
+    InterruptWait); default BusyPoll. Returns elapsed seconds between
+    ap_start and the detected ap_done.
+    """
+    waiter = waiter or BUSY_POLL
+    t0 = start_hw_conv(dev, in_buf, out_buf, wt_buf, bn_buf_hw, layer_cfg)
+    return waiter.wait(dev, layer_cfg['name'], t0, timeout)
+
+
+async def run_hw_conv_async(dev, in_buf, out_buf, wt_buf, bn_buf_hw, layer_cfg,
+                            timeout=120, waiter=None):
+    """Awaitable run_hw_conv: other coroutines run while the IP computes."""
+    waiter = waiter or BackoffPoll()
+    t0 = start_hw_conv(dev, in_buf, out_buf, wt_buf, bn_buf_hw, layer_cfg)
+    return await waiter.wait_async(dev, layer_cfg['name'], t0, timeout)
+
+
+# ── Completion waiting ──────────────────────────────────────────────────────
+# Every waiter has
+#   wait(dev, name, t0, timeout)              → seconds from t0 to ap_done
+#   async wait_async(dev, name, t0, timeout)  → same, yielding to the loop
+# and counts its AXI-Lite status reads in .reads (a proxy for bus / CPU use).
+
+class BusyPoll:
+    """Spin on REG_AP_CTRL. Lowest latency, burns one A53 core."""
+
+    def __init__(self):
+        self.reads = 0
+
+    def _done(self, dev):
+        self.reads += 1
+        return dev.read(REG_AP_CTRL) & AP_DONE
+
+    def _check_timeout(self, name, t0, timeout):
+        if time.perf_counter() - t0 > timeout:
+            raise TimeoutError(f"conv_engine timed out on {name}")
+
+    def wait(self, dev, name, t0, timeout=120):
+        while not self._done(dev):
+            self._check_timeout(name, t0, timeout)
+        return time.perf_counter() - t0
+
+    async def wait_async(self, dev, name, t0, timeout=120):
+        while not self._done(dev):
+            self._check_timeout(name, t0, timeout)
+            await asyncio.sleep(0)
+        return time.perf_counter() - t0
+
+
+BUSY_POLL = BusyPoll()
+
+
+class BackoffPoll(BusyPoll):
+    """
+    Poll with exponentially growing sleeps between reads.
+
+    Sleeps start at min_sleep and grow by `growth` up to max_sleep, so a
+    short layer is caught quickly and a long one costs a handful of reads.
+    Worst-case detection lag is max_sleep.
+    """
+
+    def __init__(self, min_sleep=20e-6, max_sleep=1e-3, growth=2.0):
+        super().__init__()
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.growth = growth
+
+    def _sleeps(self):
+        delay = self.min_sleep
+        while True:
+            yield delay
+            delay = min(delay * self.growth, self.max_sleep)
+
+    def wait(self, dev, name, t0, timeout=120):
+        for delay in self._sleeps():
+            if self._done(dev):
+                return time.perf_counter() - t0
+            self._check_timeout(name, t0, timeout)
+            time.sleep(delay)
+
+    async def wait_async(self, dev, name, t0, timeout=120):
+        for delay in self._sleeps():
+            if self._done(dev):
+                return time.perf_counter() - t0
+            self._check_timeout(name, t0, timeout)
+            await asyncio.sleep(delay)
+
+
+class PredictiveWait:
+    """
+    Sleep through most of the expected layer time, then hand over to `inner`.
+
+    Keeps an exponential moving average of each layer's duration (keyed by
+    layer name). On a call it first sleeps `margin` × that prediction
+    (nothing on the first run of a layer), then polls with `inner`
+    (default BackoffPoll) so an early finish costs at most the margin.
+    """
+
+    def __init__(self, inner=None, margin=0.9, alpha=0.25):
+        self.inner = inner or BackoffPoll()
+        self.margin = margin
+        self.alpha = alpha
+        self.history = {}            # layer name → EMA of seconds
+
+    @property
+    def reads(self):
+        return self.inner.reads
+
+    def _presleep(self, name, t0):
+        predicted = self.history.get(name)
+        if predicted is None:
+            return 0.0
+        return max(0.0, self.margin * predicted - (time.perf_counter() - t0))
+
+    def _record(self, name, elapsed):
+        prev = self.history.get(name)
+        self.history[name] = elapsed if prev is None else \
+            (1 - self.alpha) * prev + self.alpha * elapsed
+        return elapsed
+
+    def wait(self, dev, name, t0, timeout=120):
+        time.sleep(self._presleep(name, t0))
+        return self._record(name, self.inner.wait(dev, name, t0, timeout))
+
+    async def wait_async(self, dev, name, t0, timeout=120):
+        await asyncio.sleep(self._presleep(name, t0))
+        return self._record(name, await self.inner.wait_async(dev, name, t0, timeout))
+
+
+class UioInterrupt:
+    """
+    The IP's interrupt line exposed through Linux UIO (/dev/uioN).
+
+    Needs the conv_engine `interrupt` pin wired to pl_ps_irq and a
+    generic-uio device-tree node. A read of the fd blocks until the next
+    interrupt; writing 1 re-enables (unmasks) it.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def open(cls, name):
+        """Open the UIO device whose sysfs name matches (e.g. 'conv_engine')."""
+        for entry in sorted(glob.glob('/sys/class/uio/uio*')):
+            with open(os.path.join(entry, 'name')) as f:
+                if f.read().strip() == name:
+                    dev_path = '/dev/' + os.path.basename(entry)
+                    return cls(os.open(dev_path, os.O_RDWR))
+        raise FileNotFoundError(f'no UIO device named {name!r}')
+
+    def fileno(self):
+        return self.fd
+
+    def arm(self):
+        os.write(self.fd, struct.pack('I', 1))
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        os.read(self.fd, 4)              # interrupt count; consumes the event
+        return True
+
+    async def wait_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        event = loop.create_future()
+        loop.add_reader(self.fd, lambda: event.done() or event.set_result(None))
+        try:
+            await asyncio.wait_for(event, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self.fd)
+        os.read(self.fd, 4)
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InterruptWait:
+    """
+    Sleep in the kernel until the IP raises ap_done.
+
+    enable() turns on the IP's ap_done interrupt (GIE + IER) and arms the
+    UIO line. Each wait blocks on the line, reads REG_AP_CTRL once to
+    consume ap_done, acknowledges the IP by toggling REG_ISR and re-arms.
+    """
+
+    def __init__(self, irq):
+        self.irq = irq
+        self.reads = 0
+
+    def enable(self, dev):
+        dev.write(REG_IER, 1)
+        dev.write(REG_GIE, 1)
+        self.irq.arm()
+        return self
+
+    def _acknowledge(self, dev, name):
+        self.reads += 1
+        if not dev.read(REG_AP_CTRL) & AP_DONE:
+            raise RuntimeError(f'interrupt without ap_done on {name}')
+        dev.write(REG_ISR, 1)
+        self.irq.arm()
+
+    def wait(self, dev, name, t0, timeout=120):
+        remaining = timeout - (time.perf_counter() - t0)
+        if not self.irq.wait(max(remaining, 0.0)):
+            raise TimeoutError(f"conv_engine timed out on {name}")
+        elapsed = time.perf_counter() - t0
+        self._acknowledge(dev, name)
+        return elapsed
+
+    async def wait_async(self, dev, name, t0, timeout=120):
+        remaining = timeout - (time.perf_counter() - t0)
+        if not await self.irq.wait_async(max(remaining, 0.0)):
+            raise TimeoutError(f"conv_engine timed out on {name}")
+        elapsed = time.perf_counter() - t0
+        self._acknowledge(dev, name)
+        return elapsed
+
+
+# ── Devices ─────────────────────────────────────────────────────────────────
+
+class PynqDevice:
+    """The conv_engine IP on the board (pynq is imported lazily)."""
+
+    def __init__(self, ip):
+        self.ip = ip
+
+    @classmethod
+    def from_bitstream(cls, bitstream, ip_name='conv_engine_1'):
+        from pynq import Overlay
+        overlay = Overlay(bitstream)
+        device = cls(getattr(overlay, ip_name))
+        device.overlay = overlay
+        return device
+
+    def allocate(self, shape, dtype=np.int16):
+        from pynq import allocate
+        return allocate(shape=shape, dtype=dtype)
+
+    def write(self, offset, value):
+        self.ip.write(offset, value)
+
+    def read(self, offset):
+        return self.ip.read(offset)
+
+
+CACHE_LINE = 64           # Cortex-A53 L1/L2 line size, bytes
+
+
+class MockBuffer(np.ndarray):
+    """
+    pynq.allocate() stand-in with a cache model.
+
+    The array contents are what the CPU sees (its cached view); `.dram` is
+    what the IP reads and writes. Like a cacheable PYNQ buffer on the
+    ZCU102:
+      flush()      — write dirty cache lines to DRAM (DC CVAC)
+      invalidate() — write back dirty lines, then reload from DRAM
+                     (DC CIVAC: dirty CPU data overwrites IP output!)
+    so a missing flush (IP reads stale input) or invalidate (CPU reads
+    stale output) shows up as wrong results, as on the board.
+    """
+
+    def __array_finalize__(self, obj):
+        # Slices and ufunc results are plain views without a DRAM binding
+        self.physical_address = None
+        self.dram = None
+        self._device = None
+
+    def _dirty_lines(self):
+        """Byte mask of the cache lines the CPU wrote since the last sync."""
+        dirty = (self._cache_bytes != self._clean).reshape(-1, CACHE_LINE).any(axis=1)
+        return np.repeat(dirty, CACHE_LINE)
+
+    def flush(self):
+        dirty = self._dirty_lines()
+        self._dram_bytes[dirty] = self._cache_bytes[dirty]
+        self._clean[:] = self._cache_bytes
+
+    def invalidate(self):
+        dirty = self._dirty_lines()
+        self._dram_bytes[dirty] = self._cache_bytes[dirty]
+        self._cache_bytes[:] = self._dram_bytes
+        self._clean[:] = self._dram_bytes
+
+    def freebuffer(self):
+        if self._device is not None:
+            self._device.free(self)
+
+
+class MockDevice:
+    """
+    In-process conv_engine: AXI-Lite register file + bit-accurate CPU model.
+
+    Writing AP_START latches the argument registers and runs the layer on
+    conv_engine_sim in a worker thread (or inline with threaded=False),
+    reading and writing the buffers' DRAM side only. REG_AP_CTRL then
+    reads back ap_idle|ap_done, with ap_done cleared on read like the
+    HLS ap_ctrl_hs block. Per-call compute times are kept in .call_times.
+    cma_bytes caps the total allocation to emulate a small CMA pool.
+
+    latency stretches each call to at least that long (seconds, or a
+    function of the latched args), e.g. the board's per-layer times, to
+    exercise the completion waiters. With GIE and IER set, ap_done also
+    raises .interrupt, a UIO-style fd usable by InterruptWait.
+    """
+
+    BASE_ADDRESS = 0x6000_0000
+
+    def __init__(self, threaded=True, cma_bytes=None, latency=None):
+        self.threaded = threaded
+        self.cma_bytes = cma_bytes   # None = unlimited; else allocate() fails past it
+        self.latency = latency       # None, seconds, or f(args) → seconds per call
+        self.regs = {REG_AP_CTRL: AP_IDLE, REG_GIE: 0, REG_IER: 0, REG_ISR: 0}
+        self.interrupt = MockUio(self)
+        self.buffers = {}            # physical address → MockBuffer
+        self.next_address = self.BASE_ADDRESS
+        self.lock = threading.Lock()
+        self.worker = None
+        self.error = None            # exception raised by the last layer, re-raised on read
+        self.call_times = []
+
+    # ── Memory ──────────────────────────────────────────────────────────
+
+    def allocate(self, shape, dtype=np.int16):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        padded = -(-nbytes // CACHE_LINE) * CACHE_LINE
+        if self.cma_bytes is not None:
+            in_use = sum(b._cache_bytes.nbytes for b in self.buffers.values())
+            if in_use + padded > self.cma_bytes:
+                raise MemoryError(f'CMA exhausted: {padded:,d} B requested, '
+                                  f'{self.cma_bytes - in_use:,d} B free')
+        cache = np.zeros(padded, dtype=np.uint8)
+        dram = np.zeros(padded, dtype=np.uint8)
+        buf = cache[:nbytes].view(dtype).reshape(shape).view(MockBuffer)
+        buf.dram = dram[:nbytes].view(dtype).reshape(shape)
+        buf._cache_bytes, buf._dram_bytes = cache, dram
+        buf._clean = cache.copy()
+        buf._device = self
+        buf.physical_address = self.next_address
+        self.buffers[buf.physical_address] = buf
+        self.next_address += -(-padded // 4096) * 4096      # page-aligned like CMA
+        return buf
+
+    def free(self, buf):
+        self.buffers.pop(buf.physical_address, None)
+
+    def dram_at(self, address):
+        """Flat int16 DRAM view starting at a physical address."""
+        for base, buf in self.buffers.items():
+            nbytes = buf.dram.nbytes
+            if base <= address < base + nbytes:
+                offset = address - base
+                if offset % 2:
+                    raise ValueError(f'unaligned DMA address 0x{address:X}')
+                return buf.dram.reshape(-1).view(np.int16)[offset // 2:]
+        raise ValueError(f'DMA to unmapped address 0x{address:X}')
+
+    # ── AXI-Lite ───────────────────────────────────────────────────────
+
+    def write(self, offset, value):
+        value &= 0xFFFFFFFF
+        with self.lock:
+            if offset == REG_ISR:
+                self.regs[REG_ISR] ^= value      # toggle-on-write
+                return
+            if offset == REG_AP_CTRL:
+                if value & AP_START:
+                    if not self.regs[REG_AP_CTRL] & AP_IDLE:
+                        raise RuntimeError('ap_start written while conv_engine is busy')
+                    self.regs[REG_AP_CTRL] = AP_START
+                    args = self._latch_args()
+                else:
+                    return
+            else:
+                self.regs[offset] = value
+                return
+
+        if self.threaded:
+            self.worker = threading.Thread(target=self._execute, args=(args,), daemon=True)
+            self.worker.start()
+        else:
+            self._execute(args)
+
+    def read(self, offset):
+        with self.lock:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            value = self.regs.get(offset, 0)
+            if offset == REG_AP_CTRL:
+                self.regs[offset] = value & ~AP_DONE
+            return value
+
+    def _reg64(self, offset):
+        return self.regs.get(offset, 0) | (self.regs.get(offset + 4, 0) << 32)
+
+    def _reg_signed(self, offset):
+        value = self.regs.get(offset, 0)
+        return value - (1 << 32) if value & 0x80000000 else value
+
+    def _latch_args(self):
+        return dict(
+            input_dram=self._reg64(REG_INPUT_DRAM),
+            output_dram=self._reg64(REG_OUTPUT_DRAM),
+            weights_dram=self._reg64(REG_WEIGHTS_DRAM),
+            bn_params_dram=self._reg64(REG_BN_PARAMS),
+            in_channels=self._reg_signed(REG_IN_CHANNELS),
+            out_channels=self._reg_signed(REG_OUT_CHANNELS),
+            in_height=self._reg_signed(REG_IN_HEIGHT),
+            in_width=self._reg_signed(REG_IN_WIDTH),
+            kernel_size=self._reg_signed(REG_KERNEL_SIZE),
+            stride=self._reg_signed(REG_STRIDE),
+            padding=self._reg_signed(REG_PADDING),
+            use_pool=self._reg_signed(REG_USE_POOL),
+            pool_stride=self._reg_signed(REG_POOL_STRIDE),
+            use_leaky=self._reg_signed(REG_USE_LEAKY),
+        )
+
+    def _execute(self, args):
+        t0 = time.perf_counter()
+        latency = self.latency(args) if callable(self.latency) else self.latency
+        try:
+            for port in ('input_dram', 'output_dram', 'weights_dram', 'bn_params_dram'):
+                args[port] = self.dram_at(args[port])
+            conv_engine_sim.conv_engine(**args)
+        except Exception as error:
+            self.error = error
+        finally:
+            if latency:
+                time.sleep(max(0.0, latency - (time.perf_counter() - t0)))
+            self.call_times.append(time.perf_counter() - t0)
+            with self.lock:
+                self.regs[REG_AP_CTRL] = AP_IDLE | AP_DONE
+                if self.regs[REG_IER] & 1:
+                    self.regs[REG_ISR] |= 1
+                self._update_irq()
+
+    def _update_irq(self):
+        # Level interrupt: asserted while GIE and a pending enabled ISR bit
+        if self.regs[REG_GIE] & 1 and self.regs[REG_ISR] & self.regs[REG_IER] & 1:
+            self.interrupt.raise_line()
+
+    def _irq_armed(self):
+        with self.lock:
+            self._update_irq()
+
+
+class MockUio(UioInterrupt):
+    """
+    UIO line for MockDevice, backed by a pipe.
+
+    Like generic-uio the line delivers one event and then stays masked
+    until arm(); a still-pending ISR fires again as soon as it is re-armed.
+    """
+
+    def __init__(self, device):
+        read_fd, self.write_fd = os.pipe()
+        super().__init__(read_fd)
+        self.device = device
+        self.armed = False
+        self.count = 0
+
+    def arm(self):
+        self.armed = True
+        self.device._irq_armed()
+
+    def raise_line(self):
+        if self.armed:
+            self.armed = False
+            self.count += 1
+            os.write(self.write_fd, struct.pack('I', self.count))
+
+    def close(self):
+        super().close()
+        os.close(self.write_fd)
+
+
+# ── Weight residency ────────────────────────────────────────────────────────
+
+class DmaSlice:
+    """A sub-range of a DMA buffer; carries the address run_hw_conv programs."""
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset                 # int16 elements
+        self.length = length
+        self.physical_address = buf.physical_address + 2 * offset
+
+    @property
+    def array(self):
+        return self.buf[self.offset:self.offset + self.length]
+
+
+class WeightResidency:
+    """
+    All layers' weights and BN params in one contiguous DMA region.
+
+    The region is written and flushed once at start-up; afterwards a layer
+    only needs its two base addresses. Layout is
+        [w0 | bn0 | w1 | bn1 | ... ]
+    with every segment padded to a 256-bit word (16 × int16) so each base
+    address is burst-aligned.
+
+    Raises MemoryError / RuntimeError (from device.allocate) when the
+    region cannot be allocated — ConvEngineRuntime then falls back to
+    streaming.
+    """
+
+    def __init__(self, device, weights, bn_params):
+        self.weight_slices = []
+        self.bn_slices = []
+        offsets, total = param_layout([len(w) for w in weights],
+                                      [len(bn) for bn in bn_params])
+
+        self.region = device.allocate((total,), np.int16)
+        self.region[:] = 0
+        for (w_off, bn_off), w, bn in zip(offsets, weights, bn_params):
+            self.region[w_off:w_off + len(w)] = w
+            self.region[bn_off:bn_off + len(bn)] = bn
+            self.weight_slices.append(DmaSlice(self.region, w_off, len(w)))
+            self.bn_slices.append(DmaSlice(self.region, bn_off, len(bn)))
+        self.region.flush()
+
+    @property
+    def nbytes(self):
+        return self.region.nbytes
+
+    def free(self):
+        self.region.freebuffer()
+
+
+# ── Runtime ────────────────────────────────────────────────────────────────
+
+class ConvEngineRuntime:
+    """
+    Buffers + layer loop for one conv_engine device.
+
+    Parameters
+    ----------
+    device        : PynqDevice or MockDevice
+    layers        : list of LAYERS dicts (e.g. TINYYOLO_LAYERS)
+    weights       : list of int16 flat OIHW arrays, one per layer
+    bn_params     : list of int16 [s0,b0,s1,b1,...] arrays, one per layer
+    resident      : keep all weights/BN in one pre-flushed region
+                    (WeightResidency) instead of copying them every layer
+    weight_budget : max bytes for the resident region (None = no limit);
+                    above it, or if allocation fails, weights are streamed
+    waiter        : completion strategy for each layer (default
+                    PredictiveWait over BackoffPoll; BusyPoll() for the old
+                    spin loop, InterruptWait(irq).enable(device) for UIO)
+    """
+
+    def __init__(self, device, layers, weights, bn_params,
+                 resident=True, weight_budget=None, waiter=None):
+        self.device = device
+        self.waiter = waiter or PredictiveWait()
+        self.layers = [dict(L) for L in layers]
+        self.weights = weights
+        self.bn_params = bn_params
+        self.layer_times = []        # (name, seconds) of the last run
+
+        # Max-size buffers reused across layers (double-buffer for feature maps)
+        max_fm = max_wt = max_bn = 0
+        for L in self.layers:
+            oc, oh, ow = hw_output_size(L)
+            max_fm = max(max_fm, L['ic'] * L['ih'] * L['iw'], oc * oh * ow)
+            max_wt = max(max_wt, L['oc'] * L['ic'] * L['k'] * L['k'])
+            max_bn = max(max_bn, L['oc'] * 2)
+
+        # Pad to 256-bit boundary
+        self.buf_a = device.allocate((pad16(max_fm),), np.int16)
+        self.buf_b = device.allocate((pad16(max_fm),), np.int16)
+
+        # ── Weights: resident region, else per-layer streaming buffers ──
+        self.residency = None
+        self.fallback_reason = None
+        resident_bytes = 2 * sum(pad16(len(w)) + pad16(len(bn))
+                                 for w, bn in zip(weights, bn_params))
+        if not resident:
+            self.fallback_reason = 'disabled'
+        elif weight_budget is not None and resident_bytes > weight_budget:
+            self.fallback_reason = (f'{resident_bytes/2**20:.1f} MB exceeds '
+                                    f'budget {weight_budget/2**20:.1f} MB')
+        else:
+            try:
+                self.residency = WeightResidency(device, weights, bn_params)
+            except (MemoryError, RuntimeError) as error:
+                self.fallback_reason = f'allocation failed: {error}'
+
+        if self.residency is None:
+            self.weight_buf = device.allocate((pad16(max_wt),), np.int16)
+            self.bn_buf     = device.allocate((pad16(max_bn),), np.int16)
+        else:
+            self.weight_buf = self.bn_buf = None
+
+    @classmethod
+    def from_schedule(cls, device, schedule, **kwargs):
+        """Build from a compiled Schedule (tinyyolo_compile.load_schedule)."""
+        return cls(device, schedule.layers, schedule.weights, schedule.bn_params,
+                   **kwargs)
+
+    @property
+    def weight_mode(self):
+        return 'resident' if self.residency is not None else 'streaming'
+
+    def buffers(self):
+        bufs = [self.buf_a, self.buf_b]
+        if self.residency is not None:
+            return bufs + [self.residency.region]
+        return bufs + [self.weight_buf, self.bn_buf]
+
+    def free(self):
+        for buf in self.buffers():
+            buf.freebuffer()
+
+    def memory_report(self):
+        """Print the DMA memory budget: per-layer params + buffers in use."""
+        print(f"Weights: {self.weight_mode}"
+              + (f" ({self.fallback_reason})" if self.fallback_reason else ""))
+        print(f"  {'layer':6s} {'weights KB':>11s} {'BN KB':>7s}  "
+              f"{'wt addr':>12s}")
+        for idx, L in enumerate(self.layers):
+            wt_kb = len(self.weights[idx]) * 2 / 1024
+            bn_kb = len(self.bn_params[idx]) * 2 / 1024
+            addr = (f"0x{self.residency.weight_slices[idx].physical_address:010X}"
+                    if self.residency is not None else '-')
+            print(f"  {L['name']:6s} {wt_kb:11.1f} {bn_kb:7.2f}  {addr:>12s}")
+
+        param_bytes = 2 * sum(len(w) + len(bn)
+                              for w, bn in zip(self.weights, self.bn_params))
+        streamed = 0 if self.residency is not None else param_bytes
+        print(f"  Feature maps : 2 × {self.buf_a.nbytes/1024:8.1f} KB")
+        if self.residency is not None:
+            print(f"  Weight region: 1 × {self.residency.nbytes/1024:8.1f} KB")
+        else:
+            print(f"  Weight bufs  : {self.weight_buf.nbytes/1024:8.1f} KB + "
+                  f"{self.bn_buf.nbytes/1024:.1f} KB")
+        total = sum(buf.nbytes for buf in self.buffers())
+        print(f"  Total DMA    : {total/2**20:.2f} MB")
+        print(f"  Copied+flushed per frame: {streamed/2**20:.2f} MB of parameters")
+
+    def run_layer(self, idx, in_buf, out_buf):
+        """Load layer idx's parameters and run it on the IP; returns seconds."""
+        L = self.layers[idx]
+
+        if self.residency is not None:
+            # ── Resident: already in DRAM, just point the IP at them ───
+            wt_buf = self.residency.weight_slices[idx]
+            bn_buf = self.residency.bn_slices[idx]
+        else:
+            # ── Streaming: load weights & BN into DMA buffers ──────────
+            wn = len(self.weights[idx])
+            self.weight_buf[:wn] = self.weights[idx]
+            self.weight_buf.flush()
+
+            bn_n = len(self.bn_params[idx])
+            self.bn_buf[:bn_n] = self.bn_params[idx]
+            self.bn_buf.flush()
+            wt_buf, bn_buf = self.weight_buf, self.bn_buf
+
+        # Flush output buffer so cache is CLEAN before HW writes.
+        # ARM64 invalidate() does clean+invalidate (DC CIVAC) — if
+        # cache has dirty data, it writes back OVER the HW output.
+        out_buf.flush()
+
+        # Stride-1 pooling is done on the PS after the conv
+        elapsed = run_hw_conv(self.device, in_buf, out_buf, wt_buf, bn_buf,
+                              hw_layer_config(L), waiter=self.waiter)
+
+        # Invalidate output cache so ARM sees fresh data
+        out_buf.invalidate()
+        return elapsed
+
+    def run_inference(self, img_fixed_chw, verbose=True, in_buf=None):
+        """
+        Run the full network on the IP.
+
+        Layers with use_pool=1, pool_stride=1 (conv6) run on HW without
+        pooling, then SW maxpool stride-1 is applied
+        (ZeroPad2d(0,1,0,1) → MaxPool2d(2, stride=1)).
+
+        Parameters
+        ----------
+        img_fixed_chw : int16 flat array [3 * 416 * 416]
+        verbose       : bool — print per-layer timing
+        in_buf        : DMA buffer that already holds the input (e.g. a
+                        FramePipeline slot); layer 0 reads it in place and
+                        it is never written, so the next frame can be
+                        staged in a different slot meanwhile
+
+        Returns
+        -------
+        det_output : float32 [OC, H, W] of the last layer, e.g. [425, 13, 13]
+        """
+        # ── Seed input buffer ─────────────────────────────────────────
+        # (skip the copy when preprocess_frame_lut() already wrote into buf_a)
+        if in_buf is None:
+            n = len(img_fixed_chw)
+            if not np.may_share_memory(img_fixed_chw, self.buf_a):
+                self.buf_a[:n] = img_fixed_chw
+            in_buf = self.buf_a
+        in_buf.flush()
+
+        out_buf = self.buf_b if in_buf is self.buf_a else self.buf_a
+
+        total_hw = 0.0
+        self.layer_times = []
+
+        for idx, L in enumerate(self.layers):
+            elapsed = self.run_layer(idx, in_buf, out_buf)
+            total_hw += elapsed
+            self.layer_times.append((L['name'], elapsed))
+
+            oc, oh, ow = hw_output_size(L)
+            sw_pool = 'maxpool2x2_s1' in layer_sw_ops(L)
+
+            if verbose:
+                act_str = 'leaky' if L['use_leaky'] > 0 else \
+                          'relu'  if L['use_leaky'] == 0 else 'linear'
+                print(f"  {L['name']:6s}  {elapsed*1000:8.2f} ms  "
+                      f"out {oc}×{oh}×{ow}  ({act_str})"
+                      + (" [+SW pool1]" if sw_pool else ""))
+
+            # ── SW maxpool stride-1 (int16, in place on out_buf) ──────
+            if sw_pool:
+                t_pool = time.perf_counter()
+                fm_len_pool = oc * oh * ow
+                sw_maxpool_stride1_inplace(
+                    out_buf[:fm_len_pool].reshape(oc, oh, ow))
+                out_buf.flush()
+                t_pool = time.perf_counter() - t_pool
+                self.layer_times.append(('SW pool1', t_pool))
+                if verbose:
+                    print(f"    SW pool1  {t_pool*1000:8.2f} ms  "
+                          f"out {oc}×{oh}×{ow}  (maxpool 2×2 stride-1)")
+
+            # ── Swap buffers (ping-pong between buf_a / buf_b) ────────
+            in_buf, out_buf = out_buf, \
+                (self.buf_b if out_buf is self.buf_a else self.buf_a)
+
+        # After the loop, in_buf holds the last layer's output
+        det_oc, det_h, det_w = hw_output_size(self.layers[-1])
+        fm_len = det_oc * det_h * det_w
+        in_buf.invalidate()
+        det_out = fixed_to_float(
+            np.array(in_buf[:fm_len], dtype=np.int16)
+        ).reshape(det_oc, det_h, det_w)
+
+        if verbose:
+            print(f"\n  Total HW : {total_hw*1000:.2f} ms")
+        return det_out
+
+
+# ── Frame pipeline ─────────────────────────────────────────────────────────
+
+class FramePipeline:
+    """
+    Overlap PS pre/post-processing with the conv_engine across frames.
+
+    Three threads, connected by bounded queues:
+      pre  : pulls frame N+1 from the source and preprocesses it straight
+             into a free input slot (its own DMA buffer)
+      hw   : runs frame N through runtime.run_inference(in_buf=slot) —
+             the IP is the bottleneck, so this thread mostly sleeps in the
+             runtime's completion waiter
+      post : decodes / NMSes frame N-1 from its own det array
+    run() yields (frame, meta, result) in order on the caller's thread,
+    which is left free for drawing and display.
+
+    Parameters
+    ----------
+    runtime     : ConvEngineRuntime
+    preprocess  : f(frame, out) → meta; writes the int16 CHW input into out
+                  (e.g. preprocess_frame_lut(frame, out=out)[1:])
+    postprocess : f(raw [OC,H,W], meta) → result (e.g. decode + nms)
+    slots       : input buffers, i.e. frames staged or on the IP at once
+    metrics     : optional shared metrics object (PS/stage_metrics.StageMetrics,
+                  anything with add(stage, seconds) / count(name)); gets
+                  'preprocess', 'infer' and 'postprocess' per frame
+    window      : frames kept per stage in stage_times (for report() and
+                  overlays), so a long camera run stays bounded in memory
+    """
+
+    # stage_times key → metrics stage name (same names as the PS loops)
+    METRIC_STAGES = {'pre': 'preprocess', 'hw': 'infer', 'post': 'postprocess'}
+
+    def __init__(self, runtime, preprocess, postprocess, slots=3, input_size=416,
+                 metrics=None, window=300):
+        self.runtime = runtime
+        self.preprocess = preprocess
+        self.postprocess = postprocess
+        self.metrics = metrics
+        n = pad16(3 * input_size * input_size)
+        self.slots = [runtime.device.allocate((n,), np.int16) for _ in range(slots)]
+        self.stage_times = {name: collections.deque(maxlen=window)
+                            for name in self.METRIC_STAGES}
+        self.fps = 0.0
+
+    def free(self):
+        for buf in self.slots:
+            buf.freebuffer()
+
+    def _record(self, name, seconds):
+        self.stage_times[name].append(seconds)
+        if self.metrics is not None:
+            self.metrics.add(self.METRIC_STAGES[name], seconds)
+
+    # ── Queue helpers (give up when the pipeline is stopping) ───────────
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _stage(self, name, body):
+        def target():
+            try:
+                body()
+            except Exception as error:
+                self._errors.append(error)
+                self._stop.set()
+        thread = threading.Thread(target=target, name=f'pipeline-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    # ── Stages ──────────────────────────────────────────────────────────
+
+    def _pre_stage(self, frames):
+        for frame in frames:
+            slot = self._get(self._free_slots)
+            if slot is None:
+                return
+            t0 = time.perf_counter()
+            meta = self.preprocess(frame, self.slots[slot])
+            self._record('pre', time.perf_counter() - t0)
+            if not self._put(self._staged, (frame, meta, slot)):
+                return
+        self._put(self._staged, None)
+
+    def _hw_stage(self):
+        while True:
+            item = self._get(self._staged)
+            if item is None:
+                self._put(self._raw, None)
+                return
+            frame, meta, slot = item
+            t0 = time.perf_counter()
+            raw = self.runtime.run_inference(None, verbose=False,
+                                             in_buf=self.slots[slot])
+            self._record('hw', time.perf_counter() - t0)
+            self._free_slots.put(slot)
+            if not self._put(self._raw, (frame, meta, raw)):
+                return
+
+    def _post_stage(self):
+        while True:
+            item = self._get(self._raw)
+            if item is None:
+                self._put(self._results, None)
+                return
+            frame, meta, raw = item
+            t0 = time.perf_counter()
+            result = self.postprocess(raw, meta)
+            self._record('post', time.perf_counter() - t0)
+            if not self._put(self._results, (frame, meta, result)):
+                return
+
+    def run(self, frames):
+        """Generator over (frame, meta, result) for every frame in `frames`."""
+        self._stop = threading.Event()
+        self._errors = []
+        self._free_slots = queue.Queue()
+        for slot in range(len(self.slots)):
+            self._free_slots.put(slot)
+        self._staged = queue.Queue(maxsize=1)
+        self._raw = queue.Queue(maxsize=1)
+        self._results = queue.Queue(maxsize=1)
+        for times in self.stage_times.values():
+            times.clear()
+
+        threads = [self._stage('pre', lambda: self._pre_stage(frames)),
+                   self._stage('hw', self._hw_stage),
+                   self._stage('post', self._post_stage)]
+        t_start = time.perf_counter()
+        count = 0
+        try:
+            while True:
+                item = self._get(self._results)
+                if item is None:
+                    break
+                count += 1
+                self.fps = count / (time.perf_counter() - t_start)
+                if self.metrics is not None:
+                    self.metrics.count('frames')
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join(timeout=5.0)     # pre may be blocked in the source
+        if self._errors:
+            raise self._errors[0]
+
+    def report(self):
+        """Print mean per-stage times (last `window` frames) against the achieved wall FPS."""
+        for name, times in self.stage_times.items():
+            if times:
+                print(f"  {name:4s}  {np.mean(times)*1000:8.2f} ms/frame")
+        hw = self.stage_times['hw']
+        bound = 1.0 / np.mean(hw) if hw else 0.0
+        print(f"  wall {self.fps:.2f} FPS  (HW bound {bound:.2f} FPS)")
+
@@ -0,0 +1,395 @@
+"""
+Stage benchmarks for the PS inference path of run_yolo_opencv.py.
+
+Times every host-side stage on its own, with synthetic inputs so no
+camera, video or trained weights are needed:
+
+  preprocess_image / Preprocessor   480p, 720p and 1080p BGR frames
+  forward[<block>]                  each ConvBlock + detection head, on the
+                                    activation it sees in a real forward pass
+  decode_predictions                synthetic logits, N cells above threshold
+  apply_nms                         N clustered candidate boxes
+  draw_detections                   N boxes drawn on each frame size
+
+  python benchmarks/bench_stages.py run --out baseline.json
+  python benchmarks/bench_stages.py run --out current.json --baseline baseline.json
+  python benchmarks/bench_stages.py compare baseline.json current.json --threshold 0.15
+
+Every measurement is warmed up, then timed in --repeats rounds of
+--runs calls. The rounds are interleaved across all selected measurements,
+so a slow spell of the machine hits every stage a little instead of one
+stage a lot. A stage's figure is the median of its round medians. Its
+noise is the range from its fastest to its slowest round median.
+
+`compare` (and `run --baseline`) exits with status 1 when a stage's
+figure got slower than --threshold (and --min-delta ms) allows and its
+fastest current round is also slower than the slowest baseline round. A
+shift that stays inside the measured noise never fails the check.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from run_yolo_opencv import (  # noqa: E402
+    ANCHORS, COCO_CLASSES, COLORS, IMAGE_SIZE, GRID_SIZE, NUM_ANCHORS, NUM_CLASSES,
+    ConvBlock, FusedConvBlock, Preprocessor, TinyYOLO,
+    apply_nms, decode_predictions, draw_detections, fold_batchnorm, get_letterbox_plan,
+    make_detections, preprocess_image,
+)
+
+
+RESOLUTIONS = {'480p': (480, 640), '720p': (720, 1280), '1080p': (1080, 1920)}
+DENSITIES = (0, 10, 100, 500)       # cells (of 13*13*5 = 845) above the confidence threshold
+NMS_SIZES = (10, 100, 500)          # candidate boxes going into NMS
+DRAW_SIZES = (10, 50)               # boxes drawn per frame
+CONF_THRESHOLD = 0.3
+NMS_THRESHOLD = 0.4
+
+
+# ============================================
+# TIMING
+# ============================================
+
+def time_calls(fn, runs, sync=None):
+    """Wall time of `runs` consecutive fn() calls, in milliseconds"""
+    times = np.empty(runs)
+    for i in range(runs):
+        if sync is not None:
+            sync()
+        t0 = time.perf_counter()
+        fn()
+        if sync is not None:
+            sync()
+        times[i] = time.perf_counter() - t0
+    return times * 1000
+
+
+def measure(cases, runs, repeats, warmup=3):
+    """
+    Time every case in `cases` ({name: (fn, sync)}) in `repeats` interleaved
+    rounds of `runs` calls each, after `warmup` untimed calls per case.
+
+    Returns {name: statistics in ms}. median_ms is the median of the round
+    medians; best_ms / worst_ms are the lowest / highest round median.
+    """
+    for fn, sync in cases.values():
+        for _ in range(warmup):
+            fn()
+    rounds = {name: [] for name in cases}
+    for _ in range(repeats):
+        for name, (fn, sync) in cases.items():
+            rounds[name].append(time_calls(fn, runs, sync))
+
+    results = {}
+    for name, samples in rounds.items():
+        medians = np.array([np.median(r) for r in samples])
+        times = np.concatenate(samples)
+        results[name] = {
+            'median_ms': float(np.median(medians)),
+            'best_ms': float(medians.min()),
+            'worst_ms': float(medians.max()),
+            'mean_ms': float(times.mean()),
+            'min_ms': float(times.min()),
+            'p90_ms': float(np.percentile(times, 90)),
+            'runs': runs,
+            'repeats': repeats,
+        }
+    return results
+
+
+# ============================================
+# SYNTHETIC INPUTS
+# ============================================
+
+def synthetic_frame(resolution, seed=0):
+    """Smooth gradient + noise BGR frame (content does not change the cost, only the size)"""
+    h, w = RESOLUTIONS[resolution]
+    rng = np.random.RandomState(seed)
+    gradient = np.add.outer(np.linspace(0, 160, h), np.linspace(0, 80, w))
+    frame = gradient[:, :, None] + rng.randint(0, 64, size=(h, w, 3))
+    return frame.astype(np.uint8)
+
+
+def synthetic_predictions(density, batch_size=1, seed=0):
+    """
+    Detection-head logits (B, A*(5+C), G, G) with exactly `density` cells per
+    image above CONF_THRESHOLD.
+
+    Every other cell gets a very negative objectness logit. The chosen cells
+    get a confident objectness and one confident class out of a few, so the
+    survivors of decode overlap (neighbouring cells / anchors) and NMS has
+    real work to do.
+    """
+    rng = np.random.RandomState(seed)
+    cells = GRID_SIZE * GRID_SIZE * NUM_ANCHORS
+    if density > cells:
+        raise ValueError(f"density {density} exceeds the {cells} cells of the grid")
+
+    # (B, A, 5+C, G, G) view of the head layout, as decode_predictions reshapes it
+    predictions = rng.normal(0, 1, size=(batch_size, NUM_ANCHORS, 5 + NUM_CLASSES,
+                                         GRID_SIZE, GRID_SIZE)).astype(np.float32)
+    predictions[:, :, 4] = -8.0
+    predictions[:, :, 5:] -= 6.0
+    for b in range(batch_size):
+        chosen = rng.choice(cells, size=density, replace=False)
+        cy, cx, a = np.unravel_index(chosen, (GRID_SIZE, GRID_SIZE, NUM_ANCHORS))
+        predictions[b, a, 4, cy, cx] = rng.uniform(2.0, 5.0, size=density)
+        predictions[b, a, 5 + rng.randint(0, 4, size=density), cy, cx] = rng.uniform(2.0, 5.0, size=density)
+    return predictions.reshape(batch_size, -1, GRID_SIZE, GRID_SIZE)
+
+
+def synthetic_detections(count, seed=0):
+    """`count` normalized boxes jittered around count // 5 centres (pre-NMS candidates)"""
+    rng = np.random.RandomState(seed)
+    centres = rng.uniform(0.15, 0.85, size=(max(count // 5, 1), 2))
+    which = rng.randint(0, len(centres), size=count)
+    xy = centres[which] + rng.normal(0, 0.02, size=(count, 2))
+    wh = rng.uniform(0.05, 0.3, size=(count, 2))
+    boxes = np.clip(np.concatenate([xy - wh / 2, xy + wh / 2], axis=1), 0, 1)
+    return make_detections(boxes, rng.uniform(0.3, 1.0, size=count).astype(np.float32),
+                           rng.randint(0, 4, size=count))
+
+
+# ============================================
+# STAGES
+# ============================================
+
+# Each bench_* adds {name: (fn, sync)} cases; measure() times them all
+# together. Lambdas bind their inputs as defaults, since they run later.
+
+def bench_preprocess(cases):
+    for name in RESOLUTIONS:
+        frame = synthetic_frame(name)
+        cases[f'preprocess_image[{name}]'] = (lambda frame=frame: preprocess_image(frame, IMAGE_SIZE), None)
+        preprocessor = Preprocessor(frame.shape[0], frame.shape[1], IMAGE_SIZE)
+        cases[f'Preprocessor[{name}]'] = (lambda p=preprocessor, frame=frame: p(frame), None)
+
+
+def bench_forward(cases, device, fuse_bn=True):
+    """
+    Each ConvBlock (and the detection head) timed on the activation it
+    receives in a full forward pass. Weights are random: dense conv cost
+    does not depend on their values. run() times them under torch.no_grad().
+    """
+    torch.manual_seed(0)
+    model = TinyYOLO(num_classes=NUM_CLASSES, num_anchors=NUM_ANCHORS).to(device).eval()
+    if fuse_bn:
+        model = fold_batchnorm(model)
+
+    blocks = [(name, module) for name, module in model.named_children()
+              if isinstance(module, (ConvBlock, FusedConvBlock)) or name == 'detection']
+    inputs = {}
+    hooks = [module.register_forward_pre_hook(
+                 lambda module, args, name=name: inputs.__setitem__(name, args[0].clone()))
+             for name, module in blocks]
+    x = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE, device=device)
+    with torch.no_grad():
+        model(x)
+    for hook in hooks:
+        hook.remove()
+
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    for name, module in blocks:
+        # In-place LeakyReLU writes the conv output, never the captured input
+        cases[f'forward[{name}]'] = (lambda module=module, x=inputs[name]: module(x), sync)
+    cases['forward[total]'] = (lambda: model(x), sync)
+
+
+def bench_decode(cases):
+    for density in DENSITIES:
+        predictions = synthetic_predictions(density)
+        cases[f'decode_predictions[d={density}]'] = (
+            lambda predictions=predictions: decode_predictions(predictions, ANCHORS, NUM_CLASSES,
+                                                               CONF_THRESHOLD, NMS_THRESHOLD), None)
+
+
+def bench_nms(cases):
+    for count in NMS_SIZES:
+        detections = synthetic_detections(count)
+        cases[f'apply_nms[n={count}]'] = (lambda d=detections: apply_nms(d, NMS_THRESHOLD), None)
+
+
+def bench_draw(cases):
+    for name in RESOLUTIONS:
+        # Drawing over the same frame again costs the same; no per-run copy
+        frame = synthetic_frame(name)
+        plan = get_letterbox_plan(frame.shape[0], frame.shape[1], IMAGE_SIZE)
+        for count in DRAW_SIZES:
+            detections = synthetic_detections(count)
+            cases[f'draw_detections[{name},n={count}]'] = (
+                lambda frame=frame, d=detections, plan=plan: draw_detections(
+                    frame, d, plan.scale, plan.pad_w, plan.pad_h, COCO_CLASSES, COLORS, plan=plan), None)
+
+
+STAGES = {
+    'preprocess': bench_preprocess,
+    'forward': bench_forward,
+    'decode': bench_decode,
+    'nms': bench_nms,
+    'draw': bench_draw,
+}
+
+
+def environment():
+    """What the numbers depend on; compare warns when these differ"""
+    return {
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run(stages, runs, repeats, device, fuse_bn=True):
+    """Run the selected stages; returns the JSON-ready report"""
+    cases = {}
+    for stage in stages:
+        if stage == 'forward':
+            bench_forward(cases, device, fuse_bn)
+        else:
+            STAGES[stage](cases)
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        results = measure(cases, runs, repeats)
+    print(f"  {len(cases)} measurements in {time.perf_counter() - t0:.1f}s")
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'device': device.type,
+        'fuse_bn': fuse_bn,
+        'environment': environment(),
+        'results': results,
+    }
+
+
+# ============================================
+# REPORTING / REGRESSION CHECK
+# ============================================
+
+def print_results(report):
+    print(f"{'Stage':<36}{'median':>10}{'best':>10}{'worst':>10}{'p90':>10}")
+    for name, r in report['results'].items():
+        print(f"{name:<36}{r['median_ms']:>8.3f}ms{r['best_ms']:>8.3f}ms{r['worst_ms']:>8.3f}ms"
+              f"{r['p90_ms']:>8.3f}ms")
+
+
+def compare(baseline, current, threshold=0.15, min_delta_ms=0.1):
+    """
+    Compare two reports stage by stage on the median of the round medians.
+
+    A stage regresses when it is more than `threshold` (fractional) and
+    more than `min_delta_ms` slower, and the two reports' round ranges do
+    not overlap (the fastest current round is slower than the slowest
+    baseline round). Returns the names of the regressed stages.
+    """
+    base_env, cur_env = baseline.get('environment', {}), current.get('environment', {})
+    for key in sorted(set(base_env) | set(cur_env)):
+        if base_env.get(key) != cur_env.get(key):
+            print(f"Warning: {key} differs: {base_env.get(key)} -> {cur_env.get(key)}")
+
+    base, cur = baseline['results'], current['results']
+    regressed = []
+    print(f"{'Stage':<36}{'baseline':>11}{'current':>11}{'change':>9}")
+    for name in base:
+        if name not in cur:
+            print(f"{name:<36}{base[name]['median_ms']:>9.3f}ms{'-':>11}{'':>9}  (not run)")
+            continue
+        b, c = base[name]['median_ms'], cur[name]['median_ms']
+        change = c / b - 1 if b > 0 else 0.0
+        slower = change > threshold and c - b > min_delta_ms
+        # Reports written before repeats existed carry no round range
+        beyond_noise = cur[name].get('best_ms', c) > base[name].get('worst_ms', b)
+        if slower and beyond_noise:
+            regressed.append(name)
+        note = ("  REGRESSION" if beyond_noise else "  (within noise)") if slower else ""
+        print(f"{name:<36}{b:>9.3f}ms{c:>9.3f}ms{change:>+8.1%}{note}")
+    for name in cur:
+        if name not in base:
+            print(f"{name:<36}{'-':>11}{cur[name]['median_ms']:>9.3f}ms{'':>9}  (new)")
+
+    if regressed:
+        print(f"{len(regressed)} stage(s) regressed by more than {threshold:.0%}: {', '.join(regressed)}")
+    else:
+        print(f"No stage regressed by more than {threshold:.0%}")
+    return regressed
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PS-side Tiny-YOLO stages')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help='Time the stages and write a JSON report')
+    p_run.add_argument('--out', type=str, help='Path to save the JSON report')
+    p_run.add_argument('--stages', type=str, default=','.join(STAGES),
+                       help=f'Comma-separated subset of: {", ".join(STAGES)}')
+    p_run.add_argument('--runs', type=int, default=10, help='Timed calls per round')
+    p_run.add_argument('--repeats', type=int, default=5,
+                       help='Interleaved rounds per measurement (the noise range is measured across them)')
+    p_run.add_argument('--threads', type=int, help='torch.set_num_threads (pin for stable numbers)')
+    p_run.add_argument('--cuda', action='store_true', help='Run the forward stage on the GPU')
+    p_run.add_argument('--no-fuse', action='store_true', help='Forward with unfused Conv2d + BatchNorm')
+    p_run.add_argument('--baseline', type=str, help='Compare against this report afterwards')
+    p_run.add_argument('--threshold', type=float, default=0.15,
+                       help='Allowed fractional slowdown of a stage median')
+    p_run.add_argument('--min-delta', type=float, default=0.1,
+                       help='Ignore slowdowns smaller than this many ms')
+
+    p_cmp = sub.add_parser('compare', help='Compare two JSON reports; exit 1 on regression')
+    p_cmp.add_argument('baseline', type=str)
+    p_cmp.add_argument('current', type=str)
+    p_cmp.add_argument('--threshold', type=float, default=0.15,
+                       help='Allowed fractional slowdown of a stage median')
+    p_cmp.add_argument('--min-delta', type=float, default=0.1,
+                       help='Ignore slowdowns smaller than this many ms')
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        regressed = compare(load_report(args.baseline), load_report(args.current),
+                            args.threshold, args.min_delta)
+        return 1 if regressed else 0
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if args.cuda and torch.cuda.is_available() else 'cpu')
+
+    print(f"Benchmarking {', '.join(stages)} ({args.repeats} x {args.runs} runs each, "
+          f"forward on {device.type})")
+    report = run(stages, args.runs, args.repeats, device, fuse_bn=not args.no_fuse)
+    print_results(report)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved: {args.out}")
+
+    if args.baseline:
+        regressed = compare(load_report(args.baseline), report, args.threshold, args.min_delta)
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,9 +3,19 @@ import torch.nn as nn
 import numpy as np
 import cv2
 import argparse
+import collections
+import copy
+import functools
+import hashlib
+import inspect
+import json
+import platform
+import threading
 import time
 from pathlib import Path
 
+from stage_metrics import StageMetrics, JsonlWriter
+
 
 # ============================================
 # MODEL ARCHITECTURE (must match training)
@@ -95,6 +105,238 @@ class TinyYOLO(nn.Module):
         return x
 
 
+# ============================================
+# INFERENCE-OPTIMIZED MODEL (Conv+BN folding)
+# ============================================
+
+class FusedConvBlock(nn.Module):
+    """ConvBlock with BatchNorm folded into the conv: Conv2d(+bias) + in-place LeakyReLU"""
+    def __init__(self, conv, negative_slope=0.1):
+        super(FusedConvBlock, self).__init__()
+        self.conv = conv
+        self.leaky = nn.LeakyReLU(negative_slope, inplace=True)
+    
+    @classmethod
+    def from_block(cls, block):
+        """
+        Fold an eval-mode ConvBlock's BN into its conv weight and bias.
+        
+        Same math as fuse_conv_bn in the PL notebook:
+          scale = gamma / sqrt(var + eps)
+          W'    = W * scale[oc]
+          b'    = beta + scale * (conv_bias - mean)
+        computed in float64 and rounded once to the conv's dtype.
+        """
+        conv, bn = block.conv, block.bn
+        weight = conv.weight.detach().double()
+        conv_bias = (conv.bias.detach().double() if conv.bias is not None
+                     else torch.zeros(weight.shape[0], dtype=torch.float64, device=weight.device))
+        scale = bn.weight.detach().double() / torch.sqrt(bn.running_var.double() + bn.eps)
+        bias = bn.bias.detach().double() + scale * (conv_bias - bn.running_mean.double())
+        
+        fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                          conv.padding, conv.dilation, conv.groups, bias=True)
+        fused = fused.to(device=weight.device, dtype=conv.weight.dtype)
+        with torch.no_grad():
+            fused.weight.copy_(weight * scale.view(-1, 1, 1, 1))
+            fused.bias.copy_(bias)
+        return cls(fused, block.leaky.negative_slope)
+    
+    def forward(self, x):
+        return self.leaky(self.conv(x))
+
+
+def fold_batchnorm(model):
+    """Copy of an eval-mode TinyYOLO with every ConvBlock replaced by a FusedConvBlock"""
+    fused = copy.deepcopy(model).eval()
+    for name, module in model.named_children():
+        if isinstance(module, ConvBlock):
+            setattr(fused, name, FusedConvBlock.from_block(module))
+    return fused
+
+
+def _time_module(module, x, device, runs):
+    """Best-of-runs wall time of module(x) in seconds"""
+    best = float('inf')
+    for _ in range(runs + 1):           # first run is warm-up
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        module(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def report_bn_folding(model, device, runs=10):
+    """
+    Check the folded model against the unfused one and time each ConvBlock.
+    
+    Both versions of every block get the same input (captured from an
+    unfused forward pass of a random normalized image), so the per-layer
+    error does not accumulate. Returns the end-to-end max |difference| of
+    the raw detection-head outputs.
+    """
+    model = model.eval()
+    fused = fold_batchnorm(model)
+    
+    inputs = {}
+    hooks = [module.register_forward_pre_hook(
+                 lambda module, args, name=name: inputs.__setitem__(name, args[0].clone()))
+             for name, module in model.named_children() if isinstance(module, ConvBlock)]
+    
+    x = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE, generator=torch.Generator().manual_seed(0))
+    x = x.to(device)
+    with torch.no_grad():
+        reference = model(x)
+        output = fused(x)
+    for hook in hooks:
+        hook.remove()
+    
+    print(f"{'Layer':<8}{'Output':>16}{'Unfused':>11}{'Fused':>10}{'Speedup':>9}{'Max |diff|':>12}")
+    total_unfused = total_fused = 0.0
+    with torch.no_grad():
+        for name, block_in in inputs.items():
+            block, fused_block = getattr(model, name), getattr(fused, name)
+            y_ref, y_fused = block(block_in), fused_block(block_in)
+            diff = (y_ref - y_fused).abs().max().item()
+            t_unfused = _time_module(block, block_in, device, runs)
+            t_fused = _time_module(fused_block, block_in, device, runs)
+            total_unfused += t_unfused
+            total_fused += t_fused
+            shape = 'x'.join(str(d) for d in y_ref.shape[1:])
+            print(f"{name:<8}{shape:>16}{t_unfused * 1000:>9.2f}ms{t_fused * 1000:>8.2f}ms"
+                  f"{t_unfused / t_fused:>8.2f}x{diff:>12.2e}")
+    
+    max_diff = (reference - output).abs().max().item()
+    print(f"{'total':<8}{'':>16}{total_unfused * 1000:>9.2f}ms{total_fused * 1000:>8.2f}ms"
+          f"{total_unfused / total_fused:>8.2f}x")
+    print(f"Detection head max |diff|: {max_diff:.2e} "
+          f"(output range ±{reference.abs().max().item():.1f})")
+    return max_diff
+
+
+# ============================================
+# LAYER PROFILING
+# ============================================
+
+class LayerProfiler:
+    """
+    Forward-hook profiler for an eager TinyYOLO, grouped like the PL layers.
+    
+    Every ConvBlock (fused or not), pool / pad and the detection conv gets a
+    pre- and post-forward hook. Modules are grouped into the rows of the
+    conv_engine layer table: a ConvBlock plus the pad / pool that follow it
+    (conv6 = conv + pad + stride-1 pool), and the detection conv as 'det'.
+    Per row it accumulates wall time, MACs (conv only; pools do no MACs)
+    and activation bytes read + written, over every image seen.
+    """
+    
+    def __init__(self, model, device):
+        self.device = device
+        self.rows = {}          # row name -> stats dict, in forward order
+        self.hooks = []
+        self.reset()
+        
+        row = None
+        for name, module in model.named_children():
+            if isinstance(module, (ConvBlock, FusedConvBlock)):
+                row = name
+            elif name == 'detection':
+                row = 'det'
+            elif not isinstance(module, (nn.MaxPool2d, nn.ZeroPad2d)) or row is None:
+                continue        # dropout is the identity at inference
+            self.rows.setdefault(row, self._empty_row())
+            self.hooks.append(module.register_forward_pre_hook(self._start))
+            self.hooks.append(module.register_forward_hook(functools.partial(self._stop, row)))
+        self.hooks.append(model.register_forward_pre_hook(self._start_frame))
+        self.hooks.append(model.register_forward_hook(self._stop_frame))
+    
+    @staticmethod
+    def _empty_row():
+        return {'seconds': 0.0, 'macs': 0, 'bytes': 0, 'output': None}
+    
+    def reset(self):
+        """Drop everything recorded so far (e.g. after warm-up frames)"""
+        for row in self.rows:
+            self.rows[row] = self._empty_row()
+        self.images = 0
+        self.wall = 0.0
+    
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+    
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+    
+    def _start(self, module, args):
+        self._sync()
+        self._t0 = time.perf_counter()
+    
+    def _stop(self, row, module, args, output):
+        self._sync()
+        stats = self.rows[row]
+        stats['seconds'] += time.perf_counter() - self._t0
+        x = args[0]
+        stats['bytes'] += (x.numel() + output.numel()) * output.element_size()
+        if isinstance(module, nn.Conv2d) or hasattr(module, 'conv'):
+            conv = module if isinstance(module, nn.Conv2d) else module.conv
+            kh, kw = conv.kernel_size
+            stats['macs'] += output.numel() * (conv.in_channels // conv.groups) * kh * kw
+        stats['output'] = tuple(output.shape[1:])
+    
+    def _start_frame(self, module, args):
+        self._sync()
+        self._frame_t0 = time.perf_counter()
+    
+    def _stop_frame(self, module, args, output):
+        self._sync()
+        self.wall += time.perf_counter() - self._frame_t0
+        self.images += args[0].shape[0]
+    
+    def summary(self):
+        """Per-image averages: {row: {'ms', 'macs', 'bytes', 'gmacs', 'output'}}"""
+        n = max(self.images, 1)
+        summary = {}
+        for row, stats in self.rows.items():
+            seconds = stats['seconds'] / n
+            summary[row] = {
+                'ms': seconds * 1000,
+                'macs': stats['macs'] / n,
+                'bytes': stats['bytes'] / n,
+                'gmacs': stats['macs'] / n / seconds / 1e9 if seconds > 0 else 0.0,
+                'output': stats['output'],
+            }
+        return summary
+    
+    def report(self):
+        """Print the per-layer table (same rows as the PL layer table in the top-level README)"""
+        summary = self.summary()
+        n = max(self.images, 1)
+        total_ms = sum(r['ms'] for r in summary.values())
+        total_macs = sum(r['macs'] for r in summary.values())
+        total_bytes = sum(r['bytes'] for r in summary.values())
+        wall_ms = self.wall / n * 1000
+        
+        print(f"Per-layer CPU profile ({self.images} images, {self.device.type}, "
+              f"{torch.get_num_threads()} threads)")
+        print("| Layer | Time (ms) | Output | MACs (M) | Act. bytes (MB) | GMAC/s |")
+        print("|-------|-----------|--------|----------|-----------------|--------|")
+        for row, r in summary.items():
+            shape = '×'.join(str(d) for d in r['output']) if r['output'] else '—'
+            print(f"| {row} | {r['ms']:.2f} | {shape} | {r['macs'] / 1e6:.1f} "
+                  f"| {r['bytes'] / 1e6:.2f} | {r['gmacs']:.2f} |")
+        print(f"| **Total** | **{total_ms:.1f} ms** | — | {total_macs / 1e6:.1f} "
+              f"| {total_bytes / 1e6:.2f} | {total_macs / total_ms / 1e6 if total_ms else 0.0:.2f} |")
+        print(f"| **Forward wall time** | **{wall_ms:.1f} ms** | "
+              f"**{1000 / wall_ms if wall_ms else 0.0:.1f} FPS** | | | |")
+        return summary
+
+
 # ============================================
 # CONFIGURATION
 # ============================================
@@ -126,6 +368,10 @@ ANCHORS = np.array([
     [16.62, 10.52]
 ])
 
+# ImageNet normalization (must match training preprocessing)
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
 # Colors for visualization (one per class)
 np.random.seed(42)
 COLORS = np.random.randint(0, 255, size=(NUM_CLASSES, 3), dtype=np.uint8)
@@ -135,19 +381,145 @@ COLORS = np.random.randint(0, 255, size=(NUM_CLASSES, 3), dtype=np.uint8)
 # INFERENCE FUNCTIONS
 # ============================================
 
+class LetterboxPlan:
+    """
+    Letterbox geometry for one (src_h, src_w, target_size), computed once.
+    
+    Holds the resize target, pad offsets, the ROI / border regions of the
+    padded canvas and the inverse mapping from normalized boxes back to
+    source pixels. Use get_letterbox_plan() to share plans across frames.
+    """
+    __slots__ = ('src_h', 'src_w', 'target_size', 'scale', 'new_h', 'new_w',
+                 'pad_h', 'pad_w', 'roi', 'border', 'box_offset')
+    
+    def __init__(self, src_h, src_w, target_size=416):
+        self.src_h, self.src_w = src_h, src_w
+        self.target_size = target_size
+        self.scale = target_size / max(src_h, src_w)
+        self.new_h, self.new_w = int(src_h * self.scale), int(src_w * self.scale)
+        self.pad_h = (target_size - self.new_h) // 2
+        self.pad_w = (target_size - self.new_w) // 2
+        
+        # (rows, cols) slices of the canvas: resized image and gray border strips
+        ph, pw, nh, nw = self.pad_h, self.pad_w, self.new_h, self.new_w
+        self.roi = (slice(ph, ph + nh), slice(pw, pw + nw))
+        border = [
+            (slice(0, ph), slice(0, target_size)),
+            (slice(ph + nh, target_size), slice(0, target_size)),
+            (slice(ph, ph + nh), slice(0, pw)),
+            (slice(ph, ph + nh), slice(pw + nw, target_size)),
+        ]
+        self.border = tuple((rows, cols) for rows, cols in border
+                            if rows.stop > rows.start and cols.stop > cols.start)
+        self.box_offset = np.array([pw, ph, pw, ph])
+    
+    def unmap_boxes(self, boxes):
+        """Normalized (N, 4) letterboxed boxes -> int (N, 4) source pixel boxes"""
+        return unletterbox_boxes(boxes, self.scale, self.box_offset,
+                                 self.src_h, self.src_w, self.target_size)
+
+
+def unletterbox_boxes(boxes, scale, box_offset, src_h, src_w, target_size=416):
+    """Map normalized letterboxed boxes back to clamped int source pixel boxes"""
+    # Convert normalized coords to padded image coords
+    boxes_pad = (np.asarray(boxes) * target_size).astype(np.int64)
+    
+    # Remove padding and scale back to original
+    boxes = ((boxes_pad - box_offset) / scale).astype(np.int64)
+    
+    # Clamp to image bounds
+    np.clip(boxes[:, 0::2], 0, src_w - 1, out=boxes[:, 0::2])
+    np.clip(boxes[:, 1::2], 0, src_h - 1, out=boxes[:, 1::2])
+    return boxes
+
+
+@functools.lru_cache(maxsize=32)
+def get_letterbox_plan(src_h, src_w, target_size=416):
+    """Cached LetterboxPlan (a stream never changes resolution)"""
+    return LetterboxPlan(src_h, src_w, target_size)
+
+
+def parse_classes(classes, class_names=COCO_CLASSES):
+    """Class names and/or indices (list or comma-separated string) -> sorted unique index array"""
+    if isinstance(classes, str):
+        classes = [c.strip() for c in classes.split(',') if c.strip()]
+    ids = []
+    for c in classes:
+        if isinstance(c, str) and not c.isdigit():
+            if c not in class_names:
+                raise ValueError(f"Unknown class '{c}'")
+            c = class_names.index(c)
+        c = int(c)
+        if not 0 <= c < len(class_names):
+            raise ValueError(f"Class index {c} out of range 0..{len(class_names) - 1}")
+        ids.append(c)
+    if not ids:
+        raise ValueError("Empty class subset")
+    return np.unique(np.array(ids, dtype=np.int32))
+
+
+def load_roi(path):
+    """
+    Read a region of interest from disk.
+    
+    .json : one polygon [[x, y], ...] or a list of polygons, in source
+            image pixels
+    other : mask image (any resolution of the source view), nonzero = ROI
+    """
+    if Path(path).suffix.lower() == '.json':
+        with open(path) as f:
+            return json.load(f)
+    
+    mask = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not read ROI mask {path}")
+    return mask
+
+
+def roi_grid_mask(roi, plan, grid_size=GRID_SIZE):
+    """
+    Map a source-image ROI through the letterbox onto the detection grid.
+    
+    roi is one polygon ([[x, y], ...] or an (N, 2) array) or a list of
+    polygons in source pixels, or a 2-D bitmap of the source view
+    (nonzero = ROI, resized to the source if needed; any 2-D array that
+    is not (N, 2) is taken as a bitmap). A cell is kept when the ROI
+    covers any part of it, so objects centred on the ROI boundary still
+    decode. Returns a (G, G) bool mask.
+    """
+    size = plan.target_size
+    if size % grid_size:
+        raise ValueError(f"Input size {size} is not a multiple of the {grid_size}x{grid_size} grid")
+    canvas = np.zeros((size, size), dtype=np.uint8)
+    
+    if isinstance(roi, np.ndarray) and roi.ndim == 2 and roi.shape[1] != 2:
+        # INTER_AREA averages, so any ROI pixel leaves a nonzero value behind
+        bitmap = (roi != 0).astype(np.uint8) * 255
+        canvas[plan.roi] = cv2.resize(bitmap, (plan.new_w, plan.new_h), interpolation=cv2.INTER_AREA)
+    else:
+        if len(roi) and np.ndim(roi[0]) == 1:
+            roi = [roi]                         # a single polygon, not a list of them
+        offset = np.array([plan.pad_w, plan.pad_h])
+        polygons = [np.round(np.asarray(polygon, dtype=np.float64).reshape(-1, 2) * plan.scale
+                             + offset).astype(np.int32) for polygon in roi]
+        for polygon in polygons:
+            # One call per polygon: overlapping polygons filled together cancel out
+            cv2.fillPoly(canvas, [polygon], 255)
+    
+    cell = size // grid_size
+    return canvas.reshape(grid_size, cell, grid_size, cell).any(axis=(1, 3))
+
+
 def preprocess_image(image, target_size=416):
     """Preprocess image for model input"""
     # Resize
     h, w = image.shape[:2]
-    scale = target_size / max(h, w)
-    new_h, new_w = int(h * scale), int(w * scale)
-    resized = cv2.resize(image, (new_w, new_h))
+    plan = get_letterbox_plan(h, w, target_size)
+    resized = cv2.resize(image, (plan.new_w, plan.new_h))
     
     # Pad to square
     canvas = np.full((target_size, target_size, 3), 128, dtype=np.uint8)
-    pad_h = (target_size - new_h) // 2
-    pad_w = (target_size - new_w) // 2
-    canvas[pad_h:pad_h+new_h, pad_w:pad_w+new_w] = resized
+    canvas[plan.roi] = resized
     
     # Convert BGR to RGB and normalize
     rgb = cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB)
@@ -158,143 +530,370 @@ def preprocess_image(image, target_size=416):
     tensor = np.transpose(normalized, (2, 0, 1))
     tensor = np.expand_dims(tensor, 0)
     
-    return tensor, scale, pad_w, pad_h
+    return tensor, plan.scale, plan.pad_w, plan.pad_h
+
+
+class Preprocessor:
+    """
+    Letterbox + normalize frames of one fixed source resolution.
+    
+    Owns the resize buffer and a (1, 3, T, T) float32 output tensor that are
+    reused for every frame. BGR->RGB, /255 and ImageNet mean/std are folded
+    into one per-channel scale + offset, and the result is written as CHW
+    float32 straight into the output. The output can be supplied by the
+    caller (e.g. a pinned host tensor); its constant gray border is filled
+    once at construction.
+    """
+    
+    def __init__(self, src_h, src_w, target_size=416, mean=IMAGENET_MEAN, std=IMAGENET_STD,
+                 output=None):
+        self.plan = get_letterbox_plan(src_h, src_w, target_size)
+        
+        # Output channel c (RGB order) reads input channel 2 - c (BGR order):
+        #   out[c] = in[2 - c] * channel_scale[c] + channel_offset[c]
+        std = np.asarray(std, dtype=np.float32)
+        mean = np.asarray(mean, dtype=np.float32)
+        self.channel_scale = (1.0 / (255.0 * std)).astype(np.float32)
+        self.channel_offset = (-mean / std).astype(np.float32)
+        self.border_value = 128 * self.channel_scale + self.channel_offset
+        
+        self.resized = np.empty((self.plan.new_h, self.plan.new_w, 3), dtype=np.uint8)
+        if output is None:
+            output = np.empty((1, 3, target_size, target_size), dtype=np.float32)
+        self.output = output
+        self.fill_border(output)
+    
+    def fill_border(self, out):
+        """Write the normalized 128-gray letterbox border into a (3, T, T) buffer"""
+        size = self.plan.target_size
+        out = out.reshape(3, size, size)
+        for c in range(3):
+            for rows, cols in self.plan.border:
+                out[c, rows, cols] = self.border_value[c]
+    
+    def __call__(self, image, out=None, with_border=True):
+        """
+        Preprocess a BGR frame into the owned output buffer and return it.
+        
+        out         : optional other float32 (3, T, T) / (1, 3, T, T) buffer
+                      to write instead
+        with_border : (re)fill out's border; pass False when out already
+                      holds this resolution's border from an earlier call
+        """
+        plan = self.plan
+        if image.shape[:2] != (plan.src_h, plan.src_w):
+            raise ValueError(f"Preprocessor built for {plan.src_w}x{plan.src_h}, "
+                             f"got {image.shape[1]}x{image.shape[0]}")
+        
+        if out is None:
+            out = self.output
+        elif with_border:
+            self.fill_border(out)
+        chw = out.reshape(3, plan.target_size, plan.target_size)
+        
+        cv2.resize(image, (plan.new_w, plan.new_h), dst=self.resized)
+        
+        rows, cols = plan.roi
+        for c in range(3):
+            roi = chw[c, rows, cols]
+            np.multiply(self.resized[:, :, 2 - c], self.channel_scale[c], out=roi)
+            roi += self.channel_offset[c]
+        
+        return out
 
 
 def sigmoid(x):
     return 1 / (1 + np.exp(-np.clip(x, -500, 500)))
 
 
-def decode_predictions(predictions, anchors, num_classes, conf_threshold=0.3, nms_threshold=0.4):
-    """Decode YOLO predictions to bounding boxes"""
+def logit_threshold(p):
+    """Raw-logit cutoff equivalent to sigmoid(x) >= p (conservative by a small margin)"""
+    if p <= 0:
+        return -np.inf
+    # Clamp below 1 so saturated float32 sigmoids (== 1.0) still pass p >= 1,
+    # and relax by 1e-3 to absorb sigmoid rounding; survivors are re-checked.
+    p = min(p, 1 - 1e-7)
+    return float(np.log(p) - np.log1p(-p)) - 1e-3
+
+
+# One record per detection. Field names match the old per-box dicts, so
+# det['bbox'] / det['score'] / det['class'] keep working on single records.
+DETECTION_DTYPE = np.dtype([
+    ('bbox', np.float64, (4,)),     # x1, y1, x2, y2 (normalized 0-1, letterboxed)
+    ('score', np.float32),
+    ('class', np.int32),
+    ('batch', np.int32),            # image index inside the batch
+])
+
+
+def make_detections(boxes, scores, classes, batch=0):
+    """Pack parallel box/score/class arrays into a DETECTION_DTYPE array"""
+    detections = np.empty(len(scores), dtype=DETECTION_DTYPE)
+    detections['bbox'] = boxes
+    detections['score'] = scores
+    detections['class'] = classes
+    detections['batch'] = batch
+    return detections
+
+
+def as_detections(detections):
+    """Accept a DETECTION_DTYPE array or a legacy list of dicts"""
+    if isinstance(detections, np.ndarray):
+        return detections
+    if len(detections) == 0:
+        return np.empty(0, dtype=DETECTION_DTYPE)
+    return make_detections(
+        [d['bbox'] for d in detections],
+        [d['score'] for d in detections],
+        [d['class'] for d in detections],
+    )
+
+
+def detections_to_dicts(detections, class_names=None):
+    """Serialize detections to plain (JSON-ready) dicts"""
+    detections = as_detections(detections)
+    result = []
+    for bbox, score, class_idx in zip(detections['bbox'].tolist(),
+                                      detections['score'].tolist(),
+                                      detections['class'].tolist()):
+        det = {'bbox': bbox, 'score': score, 'class': class_idx}
+        if class_names is not None:
+            det['name'] = class_names[class_idx]
+        result.append(det)
+    return result
+
+
+def decode_predictions(predictions, anchors, num_classes, conf_threshold=0.3, nms_threshold=0.4,
+                       early_exit=True, stats=None, cell_mask=None, class_ids=None):
+    """
+    Decode YOLO predictions to bounding boxes
+    
+    With early_exit, cells are pruned on their raw objectness and best class
+    logits against a cutoff precomputed from conf_threshold, so sigmoid/exp
+    only ever run on the surviving rows. The class argmax is still taken on
+    the sigmoid of those rows, so the detections match the full path
+    exactly. Pass a dict as `stats` to get the number of cells pruned
+    before any transcendental math (and the time spent in NMS,
+    'nms_seconds').
+    
+    cell_mask is an optional (G, G) or (B, G, G) bool grid (see
+    roi_grid_mask): cells outside it are dropped together with the
+    objectness test, before any sigmoid, box math or NMS.
+    
+    class_ids restricts decode to a subset of the num_classes classes: only
+    their logit columns are kept, up front, and detections carry the
+    original class indices. predictions may also already hold just the
+    subset (A*(5+K) channels, e.g. from a det layer pruned on the PL).
+    """
     batch_size = predictions.shape[0]
     grid_size = predictions.shape[2]
     num_anchors = anchors.shape[0]
     
+    if class_ids is not None:
+        class_ids = np.asarray(class_ids, dtype=np.int32)
+        if predictions.shape[1] == num_anchors * (5 + num_classes):
+            # (B, A, 5+C, G, G) -> (B, A, 5+K, G, G): box/objectness + the chosen class columns
+            channels = np.concatenate([np.arange(5), 5 + class_ids])
+            predictions = predictions.reshape(batch_size, num_anchors, 5 + num_classes,
+                                              grid_size, grid_size)[:, :, channels]
+        num_classes = len(class_ids)
+    
     # Reshape: (B, A*(5+C), G, G) -> (B, G, G, A, 5+C)
     predictions = predictions.reshape(batch_size, num_anchors, 5 + num_classes, grid_size, grid_size)
     predictions = np.transpose(predictions, (0, 3, 4, 1, 2))
     
-    all_detections = []
-    
-    for b in range(batch_size):
-        detections = []
-        
-        for cy in range(grid_size):
-            for cx in range(grid_size):
-                for a in range(num_anchors):
-                    pred = predictions[b, cy, cx, a]
-                    
-                    # Get confidence
-                    conf = sigmoid(pred[4])
-                    
-                    if conf < conf_threshold:
-                        continue
-                    
-                    # Get class probabilities
-                    class_probs = sigmoid(pred[5:])
-                    class_idx = np.argmax(class_probs)
-                    class_score = class_probs[class_idx]
-                    
-                    # Final score
-                    score = conf * class_score
-                    
-                    if score < conf_threshold:
-                        continue
-                    
-                    # Decode bounding box
-                    tx, ty = sigmoid(pred[0]), sigmoid(pred[1])
-                    tw, th = pred[2], pred[3]
-                    
-                    # Convert to absolute coordinates (normalized 0-1)
-                    bx = (cx + tx) / grid_size
-                    by = (cy + ty) / grid_size
-                    bw = anchors[a, 0] * np.exp(np.clip(tw, -10, 10)) / grid_size
-                    bh = anchors[a, 1] * np.exp(np.clip(th, -10, 10)) / grid_size
-                    
-                    # Convert to corner format
-                    x1 = max(0, bx - bw / 2)
-                    y1 = max(0, by - bh / 2)
-                    x2 = min(1, bx + bw / 2)
-                    y2 = min(1, by + bh / 2)
-                    
-                    detections.append({
-                        'bbox': [x1, y1, x2, y2],
-                        'score': float(score),
-                        'class': int(class_idx)
-                    })
-        
-        # Apply NMS
-        if len(detections) > 0:
-            detections = apply_nms(detections, nms_threshold)
-        
-        all_detections.append(detections)
-    
-    return all_detections
-
-
-def compute_iou(box1, box2):
-    """Compute IoU between two boxes"""
-    x1 = max(box1[0], box2[0])
-    y1 = max(box1[1], box2[1])
-    x2 = min(box1[2], box2[2])
-    y2 = min(box1[3], box2[3])
-    
-    inter_area = max(0, x2 - x1) * max(0, y2 - y1)
-    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-    
-    return inter_area / (box1_area + box2_area - inter_area + 1e-6)
+    # (B, G, G, 1): broadcasts over the anchors of every cell
+    if cell_mask is not None:
+        cell_mask = np.asarray(cell_mask, dtype=bool).reshape(-1, grid_size, grid_size, 1)
+    
+    # Confidence mask over every (b, cy, cx, a) cell of the whole batch.
+    # np.nonzero walks the mask in row-major order, i.e. the same
+    # b -> cy -> cx -> a order the per-cell loops used to visit.
+    if early_exit:
+        cutoff = logit_threshold(conf_threshold)
+        candidates = predictions[..., 4] >= cutoff
+        if cell_mask is not None:
+            candidates &= cell_mask
+        b_idx, cy, cx, a = np.nonzero(candidates)
+        num_candidates = len(b_idx)
+        cells = predictions[b_idx, cy, cx, a]          # (N, 5+C)
+        
+        # score = conf * class_prob >= t needs class_prob >= t as well, so the
+        # best class logit must clear the same cutoff
+        keep = cells[:, 5:].max(axis=1) >= cutoff
+        b_idx, cy, cx, a = b_idx[keep], cy[keep], cx[keep], a[keep]
+        cells = cells[keep]
+        
+        # Argmax on the probabilities, as the full path does: classes whose
+        # logits differ can still round to the same float32 sigmoid, and the
+        # tie must go to the first of them
+        conf = sigmoid(cells[:, 4])
+        class_probs = sigmoid(cells[:, 5:])
+        class_idx = np.argmax(class_probs, axis=1)
+        class_score = class_probs[np.arange(len(cells)), class_idx]
+    else:
+        objectness = predictions[..., 4]
+        if cell_mask is not None:
+            # Only the cells inside the ROI ever reach the sigmoid
+            b_idx, cy, cx, a = np.nonzero(np.broadcast_to(cell_mask, objectness.shape))
+            conf = sigmoid(objectness[b_idx, cy, cx, a])
+            inside = conf >= conf_threshold
+            b_idx, cy, cx, a, conf = b_idx[inside], cy[inside], cx[inside], a[inside], conf[inside]
+        else:
+            conf = sigmoid(objectness)
+            b_idx, cy, cx, a = np.nonzero(conf >= conf_threshold)
+            conf = conf[b_idx, cy, cx, a]
+        num_candidates = len(b_idx)
+        cells = predictions[b_idx, cy, cx, a]          # (N, 5+C)
+        
+        # Class argmax only on the surviving cells
+        class_probs = sigmoid(cells[:, 5:])
+        class_idx = np.argmax(class_probs, axis=1)
+        class_score = class_probs[np.arange(len(cells)), class_idx]
+    
+    # Final score (the conf test is exact re-check of the relaxed logit cutoff)
+    score = conf * class_score
+    keep = (conf >= conf_threshold) & (score >= conf_threshold)
+    b_idx, cy, cx, a = b_idx[keep], cy[keep], cx[keep], a[keep]
+    cells, score, class_idx = cells[keep], score[keep], class_idx[keep]
+    
+    # Decode bounding boxes
+    tx, ty = sigmoid(cells[:, 0]), sigmoid(cells[:, 1])
+    tw, th = cells[:, 2], cells[:, 3]
+    
+    # Convert to absolute coordinates (normalized 0-1)
+    bx = (cx.astype(predictions.dtype) + tx) / grid_size
+    by = (cy.astype(predictions.dtype) + ty) / grid_size
+    bw = anchors[a, 0] * np.exp(np.clip(tw, -10, 10)) / grid_size
+    bh = anchors[a, 1] * np.exp(np.clip(th, -10, 10)) / grid_size
+    
+    # Convert to corner format
+    boxes = np.stack([
+        np.maximum(0, bx - bw / 2),
+        np.maximum(0, by - bh / 2),
+        np.minimum(1, bx + bw / 2),
+        np.minimum(1, by + bh / 2),
+    ], axis=1)
+    
+    # Per-class NMS image by image: boxes from different images never
+    # suppress each other, so each image only pays for its own candidates
+    # (b_idx is sorted, so every image is one contiguous slice).
+    t_nms = time.perf_counter()
+    bounds = np.searchsorted(b_idx, np.arange(batch_size + 1))
+    keep = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        image = slice(start, end)
+        keep.append(start + nms_arrays(boxes[image], score[image], class_idx[image], nms_threshold))
+    keep = np.concatenate(keep) if keep else np.empty(0, dtype=np.intp)
+    t_nms = time.perf_counter() - t_nms
+    if class_ids is not None:
+        class_idx = class_ids[class_idx]
+    detections = make_detections(boxes[keep], score[keep], class_idx[keep], b_idx[keep])
+    
+    if stats is not None:
+        num_cells = batch_size * grid_size * grid_size * num_anchors
+        stats['cells'] = num_cells
+        stats['pruned'] = num_cells - num_candidates
+        stats['candidates'] = num_candidates
+        stats['scored'] = len(score)
+        stats['kept'] = len(keep)
+        # A single (1, G, G, 1) mask stands for every image of the batch
+        outside = 0 if cell_mask is None else (~cell_mask).sum() * batch_size // len(cell_mask)
+        stats['outside_roi'] = int(outside) * num_anchors
+        stats['nms_seconds'] = t_nms
+    
+    # Per-image results are views into one contiguous array (b_idx is sorted)
+    bounds = np.searchsorted(detections['batch'], np.arange(batch_size + 1))
+    return [detections[bounds[b]:bounds[b + 1]] for b in range(batch_size)]
 
 
-def apply_nms(detections, threshold):
-    """Apply Non-Maximum Suppression"""
-    if len(detections) == 0:
-        return []
+def box_iou(boxes1, boxes2):
+    """Pairwise IoU between (N, 4) and (M, 4) corner-format boxes -> (N, M)"""
+    x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
     
-    # Sort by score
-    detections = sorted(detections, key=lambda x: x['score'], reverse=True)
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    
+    return inter_area / (area1[:, None] + area2[None, :] - inter_area + 1e-6)
+
+
+def nms_arrays(boxes, scores, classes, threshold):
+    """
+    Per-class Non-Maximum Suppression on contiguous arrays.
+    
+    boxes   : (N, 4) corner-format boxes
+    scores  : (N,)   detection scores
+    classes : (N,)   integer class (or group) ids
+    
+    Returns the indices of the kept boxes, highest score first.
+    """
+    if len(scores) == 0:
+        return np.empty(0, dtype=np.intp)
+    
+    scores = np.asarray(scores)
+    classes = np.asarray(classes)
+    boxes = np.asarray(boxes, dtype=np.float64)
+    
+    # Sort by (class, score): every class becomes one contiguous block in
+    # score order (stable, so equal scores keep input order, as sorted() did),
+    # and only its own n_c x n_c IoU block is ever computed.
+    order = np.lexsort((-scores, classes))
+    sorted_classes = classes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_classes[1:] != sorted_classes[:-1]])
+    ends = np.r_[starts[1:], len(order)]
     
     keep = []
-    while len(detections) > 0:
-        best = detections.pop(0)
-        keep.append(best)
+    for start, end in zip(starts, ends):
+        block = order[start:end]
+        iou = box_iou(boxes[block], boxes[block])
         
-        detections = [d for d in detections if 
-                      d['class'] != best['class'] or 
-                      compute_iou(best['bbox'], d['bbox']) < threshold]
+        # Greedy sweep in score order over the class's IoU block
+        suppressed = np.zeros(len(block), dtype=bool)
+        for i in range(len(block)):
+            if suppressed[i]:
+                continue
+            keep.append(block[i])
+            suppressed |= iou[i] >= threshold
     
-    return keep
+    # Back to one highest-score-first list (input order among equal scores)
+    keep = np.sort(np.asarray(keep, dtype=np.intp))
+    return keep[np.argsort(-scores[keep], kind='stable')]
 
 
-def draw_detections(image, detections, scale, pad_w, pad_h, class_names, colors):
-    """Draw bounding boxes and labels on image"""
-    h, w = image.shape[:2]
-    target_size = IMAGE_SIZE
-    
-    for det in detections:
-        bbox = det['bbox']
-        class_idx = det['class']
-        score = det['score']
-        
-        # Convert normalized coords to padded image coords
-        x1_pad = int(bbox[0] * target_size)
-        y1_pad = int(bbox[1] * target_size)
-        x2_pad = int(bbox[2] * target_size)
-        y2_pad = int(bbox[3] * target_size)
-        
-        # Remove padding and scale back to original
-        x1 = int((x1_pad - pad_w) / scale)
-        y1 = int((y1_pad - pad_h) / scale)
-        x2 = int((x2_pad - pad_w) / scale)
-        y2 = int((y2_pad - pad_h) / scale)
-        
-        # Clamp to image bounds
-        x1 = max(0, min(x1, w - 1))
-        y1 = max(0, min(y1, h - 1))
-        x2 = max(0, min(x2, w - 1))
-        y2 = max(0, min(y2, h - 1))
-        
+def apply_nms(detections, threshold):
+    """Apply Non-Maximum Suppression to a DETECTION_DTYPE array or a list of dicts"""
+    if len(detections) == 0:
+        return detections[:0] if isinstance(detections, np.ndarray) else []
+    
+    if isinstance(detections, np.ndarray):
+        keep = nms_arrays(detections['bbox'], detections['score'], detections['class'], threshold)
+        return detections[keep]
+    
+    boxes = np.array([d['bbox'] for d in detections], dtype=np.float64)
+    scores = np.array([d['score'] for d in detections])
+    classes = np.array([d['class'] for d in detections])
+    
+    return [detections[i] for i in nms_arrays(boxes, scores, classes, threshold)]
+
+
+def draw_detections(image, detections, scale, pad_w, pad_h, class_names, colors, plan=None):
+    """Draw bounding boxes and labels on image (pass `plan` to reuse its cached geometry)"""
+    detections = as_detections(detections)
+    
+    if plan is not None:
+        boxes = plan.unmap_boxes(detections['bbox'])
+    else:
+        h, w = image.shape[:2]
+        boxes = unletterbox_boxes(detections['bbox'], scale, [pad_w, pad_h, pad_w, pad_h],
+                                  h, w, IMAGE_SIZE)
+    
+    for (x1, y1, x2, y2), class_idx, score in zip(boxes.tolist(),
+                                                   detections['class'].tolist(),
+                                                   detections['score'].tolist()):
         # Get color
         color = tuple(int(c) for c in colors[class_idx])
         
@@ -312,15 +911,345 @@ def draw_detections(image, detections, scale, pad_w, pad_h, class_names, colors)
     return image
 
 
+# ============================================
+# INFERENCE BACKENDS
+# ============================================
+# Every backend maps a host float32 (B, 3, 416, 416) tensor to a NumPy
+# (B, A*(5+C), 13, 13) array, so preprocessing and decode are shared.
+# Exported graphs are cached next to the .pth and rebuilt only when the
+# weights file is newer than the artifact.
+
+def cached_artifact_path(weights_path, fuse_bn, suffix):
+    """<weights stem>[.fused]<suffix> next to the weights file"""
+    weights_path = Path(weights_path)
+    tag = '.fused' if fuse_bn else ''
+    return weights_path.with_name(f'{weights_path.stem}{tag}{suffix}')
+
+
+def artifact_is_fresh(artifact_path, weights_path):
+    artifact_path = Path(artifact_path)
+    return (artifact_path.exists()
+            and artifact_path.stat().st_mtime >= Path(weights_path).stat().st_mtime)
+
+
+def export_onnx(model, onnx_path, opset=13):
+    """Export TinyYOLO to ONNX with a dynamic batch dimension"""
+    model = copy.deepcopy(model).cpu().eval()
+    dummy = torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False        # TorchScript-based exporter, no onnxscript needed
+    with torch.no_grad():
+        torch.onnx.export(model, dummy, str(onnx_path), input_names=['images'],
+                          output_names=['predictions'], opset_version=opset,
+                          dynamic_axes={'images': {0: 'batch'}, 'predictions': {0: 'batch'}},
+                          **kwargs)
+    print(f"Exported ONNX graph: {onnx_path}")
+
+
+class EagerBackend:
+    """Plain PyTorch forward on the detector's device"""
+    name = 'eager'
+    
+    def __init__(self, model, device, weights_path, fuse_bn):
+        self.model = model
+        self.device = device
+    
+    def __call__(self, host_tensor):
+        tensor = host_tensor.to(self.device, non_blocking=True)
+        with torch.no_grad():
+            return self.model(tensor).cpu().numpy()
+
+
+class TorchScriptBackend(EagerBackend):
+    """Traced + frozen TorchScript module (cached as .pt)"""
+    name = 'torchscript'
+    
+    def __init__(self, model, device, weights_path, fuse_bn):
+        self.device = device
+        ts_path = cached_artifact_path(weights_path, fuse_bn, '.ts.pt')
+        if artifact_is_fresh(ts_path, weights_path):
+            self.model = torch.jit.load(str(ts_path), map_location=device)
+            print(f"Loaded TorchScript module: {ts_path}")
+        else:
+            dummy = torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE, device=device)
+            with torch.no_grad():
+                traced = torch.jit.trace(model.eval(), dummy)
+            self.model = torch.jit.freeze(traced)
+            torch.jit.save(self.model, str(ts_path))
+            print(f"Exported TorchScript module: {ts_path}")
+
+
+class OnnxRuntimeBackend:
+    """ONNX graph on onnxruntime's CPU execution provider (cached as .onnx)"""
+    name = 'onnxruntime'
+    
+    def __init__(self, model, device, weights_path, fuse_bn):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnxruntime backend needs: pip install onnxruntime") from None
+        
+        onnx_path = cached_artifact_path(weights_path, fuse_bn, '.onnx')
+        if not artifact_is_fresh(onnx_path, weights_path):
+            export_onnx(model, onnx_path)
+        
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # pad6 is a zero Pad in front of a stride-1 MaxPool. Once its pads are
+        # constant-folded, onnxruntime fuses it into the MaxPool's own padding
+        # (which pads with -inf, not 0) and the output is wrong. Keeping the
+        # pads computed at runtime blocks that fusion; Conv+activation fusion
+        # and the other optimizations still apply.
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options,
+                                                    providers=['CPUExecutionProvider'],
+                                                    disabled_optimizers=['ConstantFolding'])
+        self.input_name = self.session.get_inputs()[0].name
+    
+    def __call__(self, host_tensor):
+        return self.session.run(None, {self.input_name: host_tensor.numpy()})[0]
+
+
+class OpenCVDnnBackend:
+    """The same cached ONNX graph on cv2.dnn (CPU)"""
+    name = 'opencv'
+    
+    def __init__(self, model, device, weights_path, fuse_bn):
+        onnx_path = cached_artifact_path(weights_path, fuse_bn, '.onnx')
+        if not artifact_is_fresh(onnx_path, weights_path):
+            export_onnx(model, onnx_path)
+        
+        self.net = cv2.dnn.readNetFromONNX(str(onnx_path))
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    
+    def __call__(self, host_tensor):
+        self.net.setInput(host_tensor.numpy())
+        return self.net.forward()
+
+
+# ---- int8 post-training quantization (CPU) ----
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def list_images(folder, limit=None):
+    """Sorted image files in a folder (first `limit` of them)"""
+    paths = sorted(p for p in Path(folder).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    if not paths:
+        raise FileNotFoundError(f"No images ({', '.join(IMAGE_EXTENSIONS)}) in {folder}")
+    return paths[:limit] if limit else paths
+
+
+def load_image_tensors(paths):
+    """Letterboxed, normalized (1, 3, 416, 416) float32 tensors for a list of image files"""
+    tensors = []
+    for path in paths:
+        image = cv2.imread(str(path))
+        if image is None:
+            print(f"Skipping unreadable image: {path}")
+            continue
+        preprocessor = Preprocessor(image.shape[0], image.shape[1], IMAGE_SIZE)
+        tensors.append(torch.from_numpy(preprocessor(image).copy()))
+    return tensors
+
+
+def folder_digest(paths):
+    """Short hash of file names, sizes and mtimes (identifies a calibration set)"""
+    h = hashlib.sha256()
+    for path in paths:
+        stat = Path(path).stat()
+        h.update(f'{Path(path).name} {stat.st_size} {stat.st_mtime_ns}'.encode())
+    return h.hexdigest()[:16]
+
+
+def quantized_engine():
+    """qnnpack on ARM (the ZCU102 PS), x86/fbgemm elsewhere"""
+    supported = torch.backends.quantized.supported_engines
+    if platform.machine().lower() in ('aarch64', 'arm64', 'armv7l') and 'qnnpack' in supported:
+        return 'qnnpack'
+    return 'x86' if 'x86' in supported else 'fbgemm'
+
+
+def quantize_model(model, calibration, engine):
+    """
+    Post-training static int8 quantization (FX graph mode).
+    
+    Weights are quantized per output channel, activations per tensor with
+    ranges from a histogram observer run over the calibration tensors.
+    Conv+LeakyReLU pairs become fused quantized kernels; Conv+BN is folded
+    first if the model still has BatchNorm. The 1x1 detection head stays
+    fp32: its 425 outputs mix box offsets with logits down to -200, and one
+    per-tensor int8 scale for all of them costs box precision while the
+    head is <2% of the MACs.
+    """
+    from torch.ao.quantization import (QConfig, HistogramObserver,
+                                       default_per_channel_weight_observer,
+                                       get_default_qconfig_mapping)
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    
+    torch.backends.quantized.engine = engine
+    float_model = copy.deepcopy(model).cpu().eval()
+    # Dropout is identity at inference; as a module it would force a dequantize/quantize pair
+    for name, module in list(float_model.named_children()):
+        if isinstance(module, (nn.Dropout, nn.Dropout2d)):
+            setattr(float_model, name, nn.Identity())
+    
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    if engine == 'qnnpack':
+        # qnnpack's default weight observer is per-tensor
+        qconfig_mapping.set_global(QConfig(
+            activation=HistogramObserver.with_args(reduce_range=False),
+            weight=default_per_channel_weight_observer))
+    qconfig_mapping.set_module_name('detection', None)
+    
+    prepared = prepare_fx(float_model, qconfig_mapping, (calibration[0],))
+    with torch.no_grad():
+        for tensor in calibration:
+            prepared(tensor)
+    return convert_fx(prepared)
+
+
+class Int8Backend:
+    """
+    Post-training static int8 model on the CPU (cached as .int8.ts.pt).
+    
+    Calibrated on the images in calibration_dir and saved as frozen
+    TorchScript together with the engine and calibration-set digest. The
+    cache is reused while it is newer than the weights and, when a
+    calibration_dir is given, was calibrated on that same set.
+    """
+    name = 'int8'
+    
+    def __init__(self, model, device, weights_path, fuse_bn, calibration_dir=None,
+                 calibration_limit=64):
+        if device.type != 'cpu':
+            print("int8 backend runs on the CPU")
+        self.engine = quantized_engine()
+        torch.backends.quantized.engine = self.engine
+        
+        paths = list_images(calibration_dir, calibration_limit) if calibration_dir else None
+        meta = {'engine': self.engine, 'calibration': folder_digest(paths) if paths else None}
+        
+        ts_path = cached_artifact_path(weights_path, fuse_bn, '.int8.ts.pt')
+        if artifact_is_fresh(ts_path, weights_path):
+            extra = {'int8.json': ''}
+            loaded = torch.jit.load(str(ts_path), map_location='cpu', _extra_files=extra)
+            cached = json.loads(extra['int8.json'] or '{}')
+            if (paths is None and cached.get('engine') == self.engine) or cached == meta:
+                self.model = loaded
+                print(f"Loaded int8 module: {ts_path} ({self.engine})")
+                return
+        if paths is None:
+            raise ValueError(f"No up-to-date int8 model at {ts_path}; "
+                             f"pass a calibration image folder (--calib-dir) to build one")
+        
+        print(f"Calibrating int8 model on {len(paths)} images ({self.engine})...")
+        calibration = load_image_tensors(paths)
+        quantized = quantize_model(model, calibration, self.engine)
+        with torch.no_grad():
+            self.model = torch.jit.freeze(torch.jit.trace(quantized, calibration[0]))
+        torch.jit.save(self.model, str(ts_path), _extra_files={'int8.json': json.dumps(meta)})
+        print(f"Exported int8 module: {ts_path}")
+    
+    def __call__(self, host_tensor):
+        with torch.no_grad():
+            return self.model(host_tensor).numpy()
+
+
+def _latency(backend, tensor, runs):
+    """Median wall time of backend(tensor) in seconds"""
+    backend(tensor)                     # warm-up
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        backend(tensor)
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+
+def report_int8(model, int8_backend, val_dir, conf_threshold=0.3, nms_threshold=0.4,
+                batch_size=4, runs=10):
+    """
+    Compare the int8 backend with fp32 eager on a folder of validation images.
+    
+    Accuracy is measured against the fp32 detections (no labels needed):
+    a detection matches when the class agrees and IoU >= 0.5. Prints the
+    raw-output error, detection precision / recall / mean IoU and CPU
+    latency (batch 1) and throughput (batch_size). Returns the metrics.
+    """
+    fp32 = EagerBackend(copy.deepcopy(model).cpu().eval(), torch.device('cpu'), None, None)
+    tensors = load_image_tensors(list_images(val_dir))
+    
+    max_diff = mean_diff = max_obj_diff = 0.0
+    matched = n_fp32 = n_int8 = 0
+    ious = []
+    for tensor in tensors:
+        ref, out = fp32(tensor), int8_backend(tensor)
+        max_diff = max(max_diff, float(np.abs(ref - out).max()))
+        mean_diff += float(np.abs(ref - out).mean()) / len(tensors)
+        # Raw logits far below zero differ a lot but not after the sigmoid
+        objectness = [sigmoid(p.reshape(NUM_ANCHORS, 5 + NUM_CLASSES, -1)[:, 4]) for p in (ref, out)]
+        max_obj_diff = max(max_obj_diff, float(np.abs(objectness[0] - objectness[1]).max()))
+        ref_dets, out_dets = (decode_predictions(p, ANCHORS, NUM_CLASSES, conf_threshold,
+                                                 nms_threshold)[0] for p in (ref, out))
+        n_fp32 += len(ref_dets)
+        n_int8 += len(out_dets)
+        if len(ref_dets) and len(out_dets):
+            iou = box_iou(ref_dets['bbox'], out_dets['bbox'])
+            iou[ref_dets['class'][:, None] != out_dets['class'][None, :]] = 0
+            # Greedy one-to-one matching, best pairs first
+            while iou.size and iou.max() >= 0.5:
+                i, j = np.unravel_index(iou.argmax(), iou.shape)
+                ious.append(iou[i, j])
+                matched += 1
+                iou[i, :] = 0
+                iou[:, j] = 0
+    
+    precision = matched / n_int8 if n_int8 else 1.0
+    recall = matched / n_fp32 if n_fp32 else 1.0
+    print(f"Validation images: {len(tensors)}  (reference: fp32 detections)")
+    print(f"Raw output |diff|: max {max_diff:.3f}, mean {mean_diff:.4f}  "
+          f"(objectness prob max {max_obj_diff:.4f})")
+    print(f"Detections: fp32 {n_fp32}, int8 {n_int8}, matched {matched} "
+          f"(precision {precision:.3f}, recall {recall:.3f}, "
+          f"mean IoU {np.mean(ious) if ious else 0.0:.3f})")
+    
+    single = tensors[0]
+    batch = torch.cat([tensors[i % len(tensors)] for i in range(batch_size)])
+    metrics = {'max_diff': max_diff, 'mean_diff': mean_diff, 'max_objectness_diff': max_obj_diff,
+               'precision': precision,
+               'recall': recall, 'mean_iou': float(np.mean(ious)) if ious else 0.0}
+    print(f"{'CPU':<6}{'latency (b=1)':>16}{f'throughput (b={batch_size})':>22}")
+    for name, backend in (('fp32', fp32), ('int8', int8_backend)):
+        latency = _latency(backend, single, runs)
+        throughput = batch_size / _latency(backend, batch, runs)
+        metrics[f'{name}_latency_ms'] = latency * 1000
+        metrics[f'{name}_fps'] = throughput
+        print(f"{name:<6}{latency * 1000:>14.1f}ms{throughput:>18.1f} img/s")
+    return metrics
+
+
+BACKENDS = {backend.name: backend for backend in
+            (EagerBackend, TorchScriptBackend, OnnxRuntimeBackend, OpenCVDnnBackend, Int8Backend)}
+
+
 # ============================================
 # DETECTOR CLASS
 # ============================================
 
 class TinyYOLODetector:
-    def __init__(self, weights_path, device='cuda', conf_threshold=0.3, nms_threshold=0.4):
+    def __init__(self, weights_path, device='cuda', conf_threshold=0.3, nms_threshold=0.4,
+                 early_exit=True, fuse_bn=True, backend='eager', backend_options=None,
+                 profile=False, metrics=None, roi=None, classes=None):
         self.device = torch.device(device if torch.cuda.is_available() else 'cpu')
         self.conf_threshold = conf_threshold
         self.nms_threshold = nms_threshold
+        self.early_exit = early_exit
+        self.decode_stats = {}    # filled by every decode_predictions call
+        self.metrics = metrics    # StageMetrics: per-frame preprocess / infer / decode / nms
+        # Class subset (names or indices): decode only reads these logit columns
+        self.class_ids = parse_classes(classes) if classes is not None else None
         
         print(f"Using device: {self.device}")
         
@@ -349,40 +1278,250 @@ class TinyYOLODetector:
         if 'val_iou' in checkpoint:
             print(f"Model validation IoU: {checkpoint['val_iou']:.4f}")
         
+        # Inference build: BN folded into the conv weights, no BN kernels at runtime
+        if fuse_bn:
+            self.model = fold_batchnorm(self.model)
+            print("Folded BatchNorm into conv weights")
+        
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', choose from {sorted(BACKENDS)}")
+        self.backend = BACKENDS[backend](self.model, self.device, weights_path, fuse_bn,
+                                         **(backend_options or {}))
+        print(f"Inference backend: {backend}")
+        
+        # Per-layer hooks need the eager nn.Module (exported graphs have no submodules)
+        self.profiler = None
+        if profile:
+            if backend != 'eager':
+                raise ValueError(f"Layer profiling needs the eager backend, not '{backend}'")
+            self.profiler = LayerProfiler(self.model, self.device)
+        
+        self.preprocessors = {}    # (h, w) -> Preprocessor
+        self.input_buffer = None   # (B, 3, T, T) host tensor, grown to the largest batch seen
+        self.slot_sources = []     # resolution whose border is currently in each batch slot
+        
+        # Static region of interest (polygons or bitmap in source pixels, see load_roi);
+        # mapped onto the 13x13 grid once per resolution
+        self.roi = roi
+        self.roi_masks = {}        # (h, w) -> (G, G) bool cell mask
+        
         print("✓ Model loaded successfully!")
     
+    def get_preprocessor(self, image):
+        """Preprocessor for the image's resolution, built once per resolution"""
+        key = image.shape[:2]
+        preprocessor = self.preprocessors.get(key)
+        if preprocessor is None:
+            preprocessor = self.preprocessors[key] = Preprocessor(key[0], key[1], IMAGE_SIZE)
+        return preprocessor
+    
+    def get_roi_mask(self, plan):
+        """Grid cell mask of the ROI for the plan's source resolution, built once per resolution"""
+        key = (plan.src_h, plan.src_w)
+        mask = self.roi_masks.get(key)
+        if mask is None:
+            mask = self.roi_masks[key] = roi_grid_mask(self.roi, plan, GRID_SIZE)
+        return mask
+    
+    def get_input_buffer(self, batch_size):
+        """Host input tensor with room for batch_size images"""
+        if self.input_buffer is None or self.input_buffer.shape[0] < batch_size:
+            # Pinned host memory makes the copy to the GPU an async DMA
+            self.input_buffer = torch.empty((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE),
+                                            dtype=torch.float32,
+                                            pin_memory=self.device.type == 'cuda')
+            self.slot_sources = [None] * batch_size
+        return self.input_buffer[:batch_size]
+    
     def detect(self, image):
         """Run detection on a single image (BGR format)"""
-        # Preprocess
-        tensor, scale, pad_w, pad_h = preprocess_image(image, IMAGE_SIZE)
-        tensor = torch.from_numpy(tensor).float().to(self.device)
+        return self.detect_batch([image])[0]
+    
+    def detect_batch(self, images):
+        """
+        Run detection on a list of BGR images with one forward pass.
+        
+        Every image is letterboxed straight into its slot of one reused
+        (B, 3, 416, 416) input tensor; decode and NMS run vectorized over
+        the whole batch. Images may have different resolutions.
+        
+        Returns one (detections, scale, pad_w, pad_h) tuple per image.
+        """
+        if len(images) == 0:
+            return []
+        
+        t0 = time.perf_counter()
+        host_tensor = self.get_input_buffer(len(images))
+        batch = host_tensor.numpy()
+        plans = []
+        for i, image in enumerate(images):
+            preprocessor = self.get_preprocessor(image)
+            # The gray border only needs rewriting when the slot's source resolution changes
+            key = image.shape[:2]
+            preprocessor(image, out=batch[i], with_border=self.slot_sources[i] != key)
+            self.slot_sources[i] = key
+            plans.append(preprocessor.plan)
+        
+        t1 = time.perf_counter()
         
         # Inference
-        with torch.no_grad():
-            predictions = self.model(tensor)
+        predictions = self.backend(host_tensor)
+        t2 = time.perf_counter()
         
-        # Decode
-        predictions = predictions.cpu().numpy()
+        # Decode (only cells inside the ROI)
+        cell_mask = None
+        if self.roi is not None:
+            cell_mask = np.stack([self.get_roi_mask(plan) for plan in plans])
         detections = decode_predictions(
             predictions, ANCHORS, NUM_CLASSES,
-            self.conf_threshold, self.nms_threshold
-        )[0]
+            self.conf_threshold, self.nms_threshold,
+            early_exit=self.early_exit, stats=self.decode_stats, cell_mask=cell_mask,
+            class_ids=self.class_ids
+        )
+        t3 = time.perf_counter()
+        
+        if self.metrics is not None:
+            # Per-frame times: a batch's stage time is shared by its images
+            n = len(images)
+            nms_seconds = self.decode_stats['nms_seconds']
+            self.metrics.add('preprocess', (t1 - t0) / n, n)
+            self.metrics.add('infer', (t2 - t1) / n, n)
+            self.metrics.add('decode', (t3 - t2 - nms_seconds) / n, n)
+            self.metrics.add('nms', nms_seconds / n, n)
         
-        return detections, scale, pad_w, pad_h
+        return [(image_detections, plan.scale, plan.pad_w, plan.pad_h)
+                for image_detections, plan in zip(detections, plans)]
     
     def detect_and_draw(self, image):
         """Run detection and draw results on image"""
         detections, scale, pad_w, pad_h = self.detect(image)
-        result = draw_detections(image.copy(), detections, scale, pad_w, pad_h, COCO_CLASSES, COLORS)
+        plan = get_letterbox_plan(image.shape[0], image.shape[1], IMAGE_SIZE)
+        result = draw_detections(image.copy(), detections, scale, pad_w, pad_h, COCO_CLASSES, COLORS,
+                                 plan=plan)
         return result, detections
 
 
+# ============================================
+# PIPELINED RUNTIME
+# ============================================
+
+class FrameQueue:
+    """
+    Bounded FIFO between pipeline stages.
+    
+    With drop_oldest=True a put() on a full queue discards the oldest item
+    (live sources: always work on the freshest frame); otherwise put()
+    blocks until there is room (files: never lose a frame).
+    """
+    
+    def __init__(self, maxsize=2, drop_oldest=True):
+        self.maxsize = max(1, maxsize)
+        self.drop_oldest = drop_oldest
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+    
+    def put(self, item):
+        with self.cond:
+            if self.drop_oldest:
+                if len(self.items) >= self.maxsize:
+                    self.items.popleft()
+                    self.dropped += 1
+            else:
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.cond.wait()
+            self.items.append(item)
+            self.cond.notify_all()
+    
+    def get(self, timeout=None):
+        """Next item, or None once the queue is closed and drained (or on timeout)"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class PipelineFrame:
+    """One frame travelling through the pipeline, with its timestamps"""
+    __slots__ = ('index', 'image', 't_capture', 'detections', 'plan', 'result')
+    
+    def __init__(self, index, image, t_capture):
+        self.index = index
+        self.image = image
+        self.t_capture = t_capture
+        self.detections = None
+        self.plan = None
+        self.result = None
+
+
+def capture_worker(cap, frames, metrics, stop_event):
+    """Stage 1: read frames from the camera as fast as it delivers them"""
+    index = 0
+    while not stop_event.is_set():
+        t0 = time.perf_counter()
+        ret, image = cap.read()
+        t1 = time.perf_counter()
+        if not ret:
+            break
+        metrics.add('capture', t1 - t0)
+        frames.put(PipelineFrame(index, image, t1))
+        index += 1
+    frames.close()
+
+
+def inference_worker(detector, frames, results, metrics):
+    """Stage 2: detection on the freshest captured frame"""
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        t0 = time.perf_counter()
+        frame.detections, *_ = detector.detect(frame.image)
+        frame.plan = get_letterbox_plan(frame.image.shape[0], frame.image.shape[1], IMAGE_SIZE)
+        metrics.add('detect', time.perf_counter() - t0)
+        results.put(frame)
+    results.close()
+
+
+def writer_worker(writer, results, metrics):
+    """Last stage for files: draw detections and encode in order"""
+    while True:
+        frame = results.get()
+        if frame is None:
+            break
+        if writer is not None:
+            t0 = time.perf_counter()
+            result = draw_detections(frame.image, frame.detections, frame.plan.scale,
+                                     frame.plan.pad_w, frame.plan.pad_h, COCO_CLASSES, COLORS,
+                                     plan=frame.plan)
+            writer.write(result)
+            metrics.add('write', time.perf_counter() - t0)
+
+
 # ============================================
 # MAIN FUNCTIONS
 # ============================================
 
-def run_webcam(detector, camera_idx=0):
-    """Run real-time detection on webcam"""
+def run_webcam(detector, camera_idx=0, capture_queue=2, result_queue=2, metrics=None):
+    """
+    Run real-time detection on webcam
+    
+    Capture, inference and render run as a three-stage pipeline (capture
+    thread -> inference thread -> render on the main thread) connected by
+    bounded drop-oldest queues, so throughput is set by the slowest stage
+    instead of the sum of all stages. Stage latencies and dropped frames go
+    to `metrics` (a StageMetrics; a private one when not given).
+    """
     print(f"Opening camera {camera_idx}...")
     cap = cv2.VideoCapture(camera_idx)
     
@@ -395,31 +1534,59 @@ def run_webcam(detector, camera_idx=0):
     
     print("Press 'q' to quit, 's' to save screenshot")
     
-    fps_history = []
+    metrics = metrics if metrics is not None else StageMetrics()
+    detector.metrics = metrics
+    frames = FrameQueue(capture_queue)
+    results = FrameQueue(result_queue)
+    metrics.watch('dropped_before_infer', lambda: frames.dropped)
+    metrics.watch('dropped_before_render', lambda: results.dropped)
+    stop_event = threading.Event()
+    workers = [
+        threading.Thread(target=capture_worker, args=(cap, frames, metrics, stop_event), daemon=True),
+        threading.Thread(target=inference_worker, args=(detector, frames, results, metrics), daemon=True),
+    ]
+    for worker in workers:
+        worker.start()
+    
+    stages = ('capture', 'preprocess', 'infer', 'decode', 'render', 'age')
+    t_prev = None
+    frame_count = 0
     
     while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+        frame = results.get(timeout=0.1)
+        if frame is None:
+            if results.closed:
+                break
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+            continue
         
-        # Detect
-        start_time = time.time()
-        result, detections = detector.detect_and_draw(frame)
-        inference_time = time.time() - start_time
+        # Stage 3: draw + display
+        t0 = time.perf_counter()
+        result = draw_detections(frame.image, frame.detections, frame.plan.scale,
+                                 frame.plan.pad_w, frame.plan.pad_h, COCO_CLASSES, COLORS,
+                                 plan=frame.plan)
         
-        # Calculate FPS
-        fps = 1 / inference_time
-        fps_history.append(fps)
-        if len(fps_history) > 30:
-            fps_history.pop(0)
-        avg_fps = sum(fps_history) / len(fps_history)
+        # Throughput = rate at which frames leave the pipeline
+        if t_prev is not None:
+            metrics.add('interval', t0 - t_prev)
+        t_prev = t0
+        interval = metrics.mean('interval')
+        avg_fps = 1 / interval if interval > 0 else 0.0
         
         # Draw FPS
-        cv2.putText(result, f'FPS: {avg_fps:.1f} | Objects: {len(detections)}', 
+        cv2.putText(result, f'FPS: {avg_fps:.1f} | Objects: {len(frame.detections)}', 
                     (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+        cv2.putText(result, metrics.summary(stages), (10, 60),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
         
         # Show
         cv2.imshow('Tiny-YOLO Detection', result)
+        t1 = time.perf_counter()
+        metrics.add('render', t1 - t0)
+        metrics.add('age', t1 - frame.t_capture)   # end-to-end: capture -> on screen
+        metrics.count('frames')
+        frame_count += 1
         
         key = cv2.waitKey(1) & 0xFF
         if key == ord('q'):
@@ -429,12 +1596,26 @@ def run_webcam(detector, camera_idx=0):
             cv2.imwrite(filename, result)
             print(f"Saved: {filename}")
     
+    stop_event.set()
+    frames.close()
+    results.close()
+    for worker in workers:
+        worker.join(timeout=2)
+    
+    print(f"Displayed {frame_count} frames")
+    metrics.report()
+    
     cap.release()
     cv2.destroyAllWindows()
 
 
-def run_video(detector, video_path, output_path=None):
-    """Run detection on video file"""
+def run_video(detector, video_path, output_path=None, headless=False, batch_size=4, read_ahead=16,
+              metrics=None):
+    """Run detection on video file (stage latencies go to `metrics`, a StageMetrics)"""
+    if headless:
+        return run_video_headless(detector, video_path, output_path, batch_size, read_ahead,
+                                  metrics)
+    
     print(f"Processing video: {video_path}")
     cap = cv2.VideoCapture(video_path)
     
@@ -456,14 +1637,23 @@ def run_video(detector, video_path, output_path=None):
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
         writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
     
+    metrics = metrics if metrics is not None else StageMetrics()
+    detector.metrics = metrics
     frame_count = 0
     
     while True:
+        t0 = time.perf_counter()
         ret, frame = cap.read()
         if not ret:
             break
+        metrics.add('capture', time.perf_counter() - t0)
+        
+        detections, scale, pad_w, pad_h = detector.detect(frame)
         
-        result, detections = detector.detect_and_draw(frame)
+        t0 = time.perf_counter()
+        plan = get_letterbox_plan(frame.shape[0], frame.shape[1], IMAGE_SIZE)
+        result = draw_detections(frame, detections, scale, pad_w, pad_h, COCO_CLASSES, COLORS,
+                                 plan=plan)
         
         frame_count += 1
         print(f"\rFrame {frame_count}/{total_frames} - {len(detections)} objects", end='')
@@ -472,10 +1662,13 @@ def run_video(detector, video_path, output_path=None):
             writer.write(result)
         
         cv2.imshow('Tiny-YOLO Detection', result)
+        metrics.add('render', time.perf_counter() - t0)
+        metrics.count('frames')
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
     
     print(f"\nProcessed {frame_count} frames")
+    metrics.report()
     
     cap.release()
     if writer:
@@ -484,7 +1677,91 @@ def run_video(detector, video_path, output_path=None):
     cv2.destroyAllWindows()
 
 
-def run_image(detector, image_path, output_path=None):
+def run_video_headless(detector, video_path, output_path=None, batch_size=4, read_ahead=16,
+                       metrics=None):
+    """
+    Offline detection on a video file, no display
+    
+    A decoder thread reads up to read_ahead frames ahead into a blocking
+    queue (no frame is ever dropped), the main thread runs inference on
+    batches of batch_size frames per forward pass, and a writer thread
+    draws and encodes the annotated frames in order.
+    """
+    print(f"Processing video (headless, batch {batch_size}): {video_path}")
+    cap = cv2.VideoCapture(video_path)
+    
+    if not cap.isOpened():
+        print(f"Error: Could not open video {video_path}")
+        return
+    
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    
+    print(f"Video: {width}x{height} @ {fps:.1f} FPS, {total_frames} frames")
+    
+    writer = None
+    if output_path:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+    
+    batch_size = max(1, batch_size)
+    metrics = metrics if metrics is not None else StageMetrics()
+    detector.metrics = metrics
+    frames = FrameQueue(max(read_ahead, batch_size), drop_oldest=False)
+    results = FrameQueue(max(read_ahead, batch_size), drop_oldest=False)
+    stop_event = threading.Event()
+    workers = [
+        threading.Thread(target=capture_worker, args=(cap, frames, metrics, stop_event), daemon=True),
+        threading.Thread(target=writer_worker, args=(writer, results, metrics), daemon=True),
+    ]
+    
+    t_start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    
+    frame_count = 0
+    object_count = 0
+    
+    while True:
+        batch = []
+        while len(batch) < batch_size:
+            frame = frames.get()
+            if frame is None:
+                break
+            batch.append(frame)
+        if not batch:
+            break
+        
+        detections = detector.detect_batch([frame.image for frame in batch])
+        metrics.count('frames', len(batch))
+        
+        for frame, (frame_detections, *_) in zip(batch, detections):
+            frame.detections = frame_detections
+            frame.plan = get_letterbox_plan(frame.image.shape[0], frame.image.shape[1], IMAGE_SIZE)
+            results.put(frame)
+            object_count += len(frame_detections)
+        
+        frame_count += len(batch)
+        print(f"\rFrame {frame_count}/{total_frames} - {object_count} objects", end='')
+    
+    results.close()
+    for worker in workers:
+        worker.join()
+    wall_time = time.perf_counter() - t_start
+    
+    print(f"\nProcessed {frame_count} frames in {wall_time:.2f} s "
+          f"({frame_count / wall_time if wall_time > 0 else 0.0:.1f} FPS)")
+    metrics.report()
+    
+    cap.release()
+    if writer:
+        writer.release()
+        print(f"Saved: {output_path}")
+
+
+def run_image(detector, image_path, output_path=None, json_path=None):
     """Run detection on single image"""
     print(f"Processing image: {image_path}")
     
@@ -498,23 +1775,62 @@ def run_image(detector, image_path, output_path=None):
     inference_time = time.time() - start_time
     
     print(f"Inference time: {inference_time*1000:.1f} ms")
+    stats = detector.decode_stats
+    if stats:
+        print(f"Decode: pruned {stats['pruned']}/{stats['cells']} cells on raw logits, "
+              f"{stats['scored']} scored, {stats['kept']} kept after NMS")
     print(f"Found {len(detections)} objects:")
     
-    for det in detections:
-        class_name = COCO_CLASSES[det['class']]
-        score = det['score']
-        print(f"  - {class_name}: {score:.2f}")
+    for class_idx, score in zip(detections['class'].tolist(), detections['score'].tolist()):
+        print(f"  - {COCO_CLASSES[class_idx]}: {score:.2f}")
     
     if output_path:
         cv2.imwrite(output_path, result)
         print(f"Saved: {output_path}")
     
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(detections_to_dicts(detections, COCO_CLASSES), f, indent=2)
+        print(f"Saved: {json_path}")
+    
     cv2.imshow('Tiny-YOLO Detection', result)
     print("Press any key to close...")
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
 
+def run_profile(detector, source, frames=20, warmup=2):
+    """
+    Profile the CPU model layer by layer over `frames` frames and print the table.
+    
+    source is an image path (the image is reused for every frame), a video
+    path or a camera index. The first `warmup` frames are not counted.
+    """
+    image = cv2.imread(source) if isinstance(source, str) else None
+    cap = None
+    if image is None:
+        cap = cv2.VideoCapture(source)
+        if not cap.isOpened():
+            print(f"Error: Could not open {source}")
+            return None
+    
+    try:
+        for i in range(warmup + frames):
+            if i == warmup:
+                detector.profiler.reset()
+            if cap is not None:
+                ret, image = cap.read()
+                if not ret:
+                    print(f"Source ended after {i - warmup} profiled frames")
+                    break
+            detector.detect(image)
+    finally:
+        if cap is not None:
+            cap.release()
+    
+    return detector.profiler.report()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Tiny-YOLO Object Detection with OpenCV')
     parser.add_argument('--weights', type=str, default='tiny_yolo_best.pth',
@@ -523,9 +1839,47 @@ def main():
     parser.add_argument('--video', type=str, help='Path to input video')
     parser.add_argument('--camera', type=int, default=0, help='Camera index')
     parser.add_argument('--output', type=str, help='Path to save output')
+    parser.add_argument('--capture-queue', type=int, default=2,
+                        help='Webcam: max captured frames waiting for inference (oldest dropped)')
+    parser.add_argument('--result-queue', type=int, default=2,
+                        help='Webcam: max inferred frames waiting for display (oldest dropped)')
+    parser.add_argument('--headless', action='store_true',
+                        help='Video: no display; decode, batch inference and writing run in parallel')
+    parser.add_argument('--batch', type=int, default=4,
+                        help='Headless video: frames per forward pass')
+    parser.add_argument('--read-ahead', type=int, default=16,
+                        help='Headless video: max decoded frames buffered ahead of inference')
+    parser.add_argument('--json', type=str, help='Path to save detections as JSON (image mode)')
     parser.add_argument('--conf', type=float, default=0.3, help='Confidence threshold')
     parser.add_argument('--nms', type=float, default=0.4, help='NMS threshold')
     parser.add_argument('--cpu', action='store_true', help='Use CPU instead of GPU')
+    parser.add_argument('--no-early-exit', action='store_true',
+                        help='Decode with sigmoid on every cell instead of raw-logit pruning')
+    parser.add_argument('--backend', type=str, default='eager', choices=sorted(BACKENDS),
+                        help='Inference runtime (exported graphs are cached next to the weights)')
+    parser.add_argument('--no-fuse', action='store_true',
+                        help='Keep separate Conv2d + BatchNorm layers instead of folding BN')
+    parser.add_argument('--verify-fusion', action='store_true',
+                        help='Compare BN-folded vs unfused model per layer (accuracy + speed) and exit')
+    parser.add_argument('--calib-dir', type=str,
+                        help='int8 backend: calibration image folder (builds/refreshes the cached model)')
+    parser.add_argument('--calib-images', type=int, default=64,
+                        help='int8 backend: max calibration images used')
+    parser.add_argument('--val-dir', type=str,
+                        help='int8 backend: report accuracy vs fp32 and CPU latency on these images, then exit')
+    parser.add_argument('--profile', type=int, metavar='N',
+                        help='Time every layer (eager backend) over N frames of the input, print the table and exit')
+    parser.add_argument('--classes', type=str,
+                        help='Only detect these classes, e.g. person,car,truck,bus,bicycle,motorcycle')
+    parser.add_argument('--roi', type=str,
+                        help='Region of interest: JSON polygon(s) in source pixels or a mask image; '
+                             'grid cells outside it are skipped in decode')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Webcam/video: serve Prometheus stage metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-jsonl', type=str,
+                        help='Webcam/video: append a stage-metrics snapshot to this JSONL file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=5.0,
+                        help='Seconds between JSONL metrics snapshots')
     
     args = parser.parse_args()
     
@@ -537,21 +1891,63 @@ def main():
         return
     
     # Initialize detector
-    device = 'cpu' if args.cpu else 'cuda'
+    device = 'cpu' if args.cpu or args.backend == 'int8' else 'cuda'
+    backend_options = None
+    if args.backend == 'int8':
+        backend_options = {'calibration_dir': args.calib_dir,
+                           'calibration_limit': args.calib_images}
     detector = TinyYOLODetector(
         weights_path=str(weights_path),
         device=device,
         conf_threshold=args.conf,
-        nms_threshold=args.nms
+        nms_threshold=args.nms,
+        early_exit=not args.no_early_exit,
+        fuse_bn=not (args.no_fuse or args.verify_fusion),
+        backend=args.backend,
+        backend_options=backend_options,
+        profile=bool(args.profile),
+        roi=load_roi(args.roi) if args.roi else None,
+        classes=args.classes
     )
     
+    if args.verify_fusion:
+        report_bn_folding(detector.model, detector.device)
+        return
+    
+    if args.val_dir:
+        if args.backend != 'int8':
+            print("Error: --val-dir reports on the int8 backend; add --backend int8")
+            return
+        report_int8(detector.model, detector.backend, args.val_dir, args.conf, args.nms,
+                    args.batch)
+        return
+    
+    if args.profile:
+        source = args.image or args.video or args.camera
+        run_profile(detector, source, args.profile)
+        return
+    
     # Run appropriate mode
     if args.image:
-        run_image(detector, args.image, args.output)
-    elif args.video:
-        run_video(detector, args.video, args.output)
-    else:
-        run_webcam(detector, args.camera)
+        run_image(detector, args.image, args.output, args.json)
+        return
+    
+    metrics = StageMetrics()
+    server = metrics.serve(args.metrics_port) if args.metrics_port is not None else None
+    jsonl = (JsonlWriter(metrics, args.metrics_jsonl, args.metrics_interval)
+             if args.metrics_jsonl else None)
+    try:
+        if args.video:
+            run_video(detector, args.video, args.output, args.headless, args.batch, args.read_ahead,
+                      metrics)
+        else:
+            run_webcam(detector, args.camera, args.capture_queue, args.result_queue, metrics)
+    finally:
+        if jsonl is not None:
+            jsonl.close()
+            print(f"Saved: {args.metrics_jsonl}")
+        if server is not None:
+            server.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,226 @@
+"""
+Shared per-frame latency metrics for the detection loops.
+
+One StageMetrics object is written to by every stage of a loop (capture,
+preprocess, infer, decode, NMS, render, ...) from any thread. Each sample
+costs a lock, a bisect over fixed log-spaced buckets and a deque append,
+so it can stay on in production. Percentiles (p50 / p95 / p99) come from
+the cumulative histograms; the overlay means come from a short sliding
+window of recent samples.
+
+Export either way (or both):
+  metrics.serve(9100)                    Prometheus text on http://127.0.0.1:9100/metrics
+  JsonlWriter(metrics, 'metrics.jsonl')  one JSON snapshot per line every few seconds
+
+Used by run_yolo_opencv.py (webcam / video loops) and by the PL notebook's
+FramePipeline camera loop.
+"""
+import bisect
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Histogram bucket upper bounds in seconds: 8 per decade, 10 us .. 100 s
+# (neighbouring bounds are 33% apart, which bounds the percentile error)
+BUCKETS = tuple(10 ** (e / 8) for e in range(-40, 17))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (seconds)"""
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # last bucket: > BUCKETS[-1]
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def observe(self, seconds, n=1):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += n
+        self.count += n
+        self.total += seconds * n
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Estimate by linear interpolation inside the bucket, clamped to the observed range"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                value = lower + (upper - lower) * (rank - seen) / n
+                return min(max(value, self.min), self.max)
+            seen += n
+        return self.max
+
+
+class StageMetrics:
+    """
+    Thread-safe per-stage latency histograms plus event counters.
+
+    add(stage, seconds)  : record one sample (seconds per frame); n=k
+                           records k frames that each took `seconds`
+    count(name, n)       : bump a counter, e.g. 'frames'
+    watch(name, fn)      : counter read from fn() at export time, e.g. a
+                           queue's drop count (no per-frame cost at all)
+    mean(stage)          : mean of the last `window` samples (for overlays)
+    """
+
+    def __init__(self, window=30, prefix='tinyyolo'):
+        self.prefix = prefix
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}                        # stage -> Histogram, first-seen order
+        self.recent = {}                            # stage -> deque of the last samples
+        self.counters = collections.Counter()
+        self.sources = {}                           # counter name -> fn()
+        self.started = time.time()
+
+    def add(self, stage, seconds, n=1):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+                self.recent[stage] = collections.deque(maxlen=self.window)
+            histogram.observe(seconds, n)
+            self.recent[stage].append(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def watch(self, name, fn):
+        self.sources[name] = fn
+
+    def mean(self, stage):
+        with self.lock:
+            samples = self.recent.get(stage)
+            return sum(samples) / len(samples) if samples else 0.0
+
+    def summary(self, stages):
+        return ' | '.join(f'{stage} {self.mean(stage) * 1000:.1f}ms' for stage in stages)
+
+    def counter_values(self):
+        values = dict(self.counters)
+        for name, fn in self.sources.items():
+            values[name] = fn()
+        return values
+
+    def snapshot(self):
+        """JSON-ready totals: per-stage count / mean / p50 / p95 / p99 / max (ms) and counters"""
+        with self.lock:
+            stages = {}
+            for stage, h in self.histograms.items():
+                stages[stage] = {
+                    'count': h.count,
+                    'mean_ms': h.total / h.count * 1000 if h.count else 0.0,
+                    **{f'p{int(q * 100)}_ms': h.quantile(q) * 1000 for q in QUANTILES},
+                    'max_ms': h.max * 1000,
+                }
+            counters = self.counter_values()
+        return {
+            'time': time.time(),
+            'uptime_s': time.time() - self.started,
+            'stages': stages,
+            'counters': counters,
+        }
+
+    def prometheus_text(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        name = f'{self.prefix}_stage_seconds'
+        lines = [f'# HELP {name} Per-frame latency of each pipeline stage.',
+                 f'# TYPE {name} histogram']
+        quantile_lines = []
+        with self.lock:
+            for stage, h in self.histograms.items():
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.total:.9g}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+                for q in QUANTILES:
+                    quantile_lines.append(f'{self.prefix}_stage_quantile_seconds'
+                                          f'{{stage="{stage}",quantile="{q}"}} {h.quantile(q):.9g}')
+            counters = self.counter_values()
+
+        lines.append(f'# HELP {self.prefix}_stage_quantile_seconds Estimated latency percentiles.')
+        lines.append(f'# TYPE {self.prefix}_stage_quantile_seconds gauge')
+        lines.extend(quantile_lines)
+        for counter, value in sorted(counters.items()):
+            lines.append(f'# TYPE {self.prefix}_{counter}_total counter')
+            lines.append(f'{self.prefix}_{counter}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """Print the p50 / p95 / p99 table and the counters"""
+        snapshot = self.snapshot()
+        print(f"{'Stage':<12}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for stage, s in snapshot['stages'].items():
+            print(f"{stage:<12}{s['count']:>8}{s['mean_ms']:>8.1f}ms{s['p50_ms']:>8.1f}ms"
+                  f"{s['p95_ms']:>8.1f}ms{s['p99_ms']:>8.1f}ms{s['max_ms']:>8.1f}ms")
+        if snapshot['counters']:
+            print(' | '.join(f'{name} {value}' for name, value in sorted(snapshot['counters'].items())))
+        return snapshot
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve prometheus_text() on http://host:port/metrics from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass                                # no per-scrape console lines
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        print(f"Metrics: http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+class JsonlWriter:
+    """Append a StageMetrics snapshot to a JSONL file every `interval` seconds (and on close)"""
+
+    def __init__(self, metrics, path, interval=5.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-jsonl', daemon=True)
+        self.thread.start()
+
+    def write(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.metrics.snapshot()) + '\n')
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()